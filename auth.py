@@ -0,0 +1,93 @@
+import Queue
+import requests
+import sqlite3
+import threading
+import time
+import traceback
+
+class HttpBackend(object):
+    # checks access tokens against the web api, with one pooled session
+    # per worker thread
+    def __init__(self, url):
+        self.url = url
+        self.local = threading.local()
+    def check(self, username, access_token):
+        session = getattr(self.local, 'session', None)
+        if session is None:
+            session = self.local.session = requests.Session()
+        payload = {
+            'username': username,
+            'access_token': access_token,
+        }
+        response = session.post(self.url, data=payload, timeout=10)
+        if response.status_code == 200 and response.text.isdigit():
+            return int(response.text)
+        return None
+
+class SqliteBackend(object):
+    # checks access tokens against a local user table, for testing and
+    # private servers
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        connection = sqlite3.connect(path)
+        connection.execute(
+            'create table if not exists user ('
+            '    user_id integer primary key,'
+            '    username text not null unique,'
+            '    access_token text not null'
+            ');')
+        connection.commit()
+        connection.close()
+    def check(self, username, access_token):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = self.local.connection = sqlite3.connect(self.path)
+        query = (
+            'select user_id from user where '
+            'username = ? and access_token = ?;'
+        )
+        rows = list(connection.execute(query, (username, access_token)))
+        return rows[0][0] if rows else None
+
+class Authenticator(object):
+    # runs backend checks on worker threads and remembers verified
+    # (username, access_token) pairs for ttl seconds; callbacks run on the
+    # worker thread, or inline on a cache hit
+    def __init__(self, backend, workers=4, ttl=300):
+        self.backend = backend
+        self.ttl = ttl
+        self.cache = {}
+        self.lock = threading.Lock()
+        self.queue = Queue.Queue()
+        for _ in range(workers):
+            thread = threading.Thread(target=self.run)
+            thread.setDaemon(True)
+            thread.start()
+    def authenticate(self, username, access_token, callback):
+        key = (username, access_token)
+        with self.lock:
+            user_id, expires = self.cache.get(key, (None, 0))
+        if expires > time.time():
+            callback(user_id)
+        else:
+            self.queue.put((key, callback))
+    def run(self):
+        while True:
+            key, callback = self.queue.get()
+            try:
+                user_id = self.backend.check(*key)
+            except Exception:
+                traceback.print_exc()
+                user_id = None
+            if user_id is not None:
+                with self.lock:
+                    self.cache[key] = (user_id, time.time() + self.ttl)
+                    self.expire()
+            callback(user_id)
+    def expire(self):
+        # called with the lock held
+        now = time.time()
+        for key, (_, expires) in self.cache.items():
+            if expires <= now:
+                del self.cache[key]
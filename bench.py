@@ -0,0 +1,145 @@
+# Micro-benchmarks for the server hot paths.
+# Usage: python bench.py [NAME ...]
+
+from framing import LineFramer
+from storage import Storage
+import os
+import random
+import sys
+import tempfile
+import time
+
+BUFFER_SIZE = 4096
+
+def timeit(func, duration=1.0):
+    count = 0
+    start = time.time()
+    while True:
+        func()
+        count += 1
+        elapsed = time.time() - start
+        if elapsed >= duration:
+            return count / elapsed
+
+def split(data, size=BUFFER_SIZE):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+def legacy_frame(chunks):
+    result = []
+    buf = []
+    for data in chunks:
+        buf.extend(data.replace('\r\n', '\n'))
+        while '\n' in buf:
+            index = buf.index('\n')
+            line = ''.join(buf[:index])
+            buf = buf[index + 1:]
+            if line:
+                result.append(line)
+    return result
+
+def framer_frame(chunks):
+    result = []
+    framer = LineFramer()
+    for data in chunks:
+        result.extend(framer.feed(data))
+    return result
+
+def bench_framing():
+    for count in (1, 10, 10000):
+        data = ''.join('B,%d,32,%d,3\n' % (i, -i) for i in range(count))
+        chunks = split(data)
+        assert legacy_frame(chunks) == framer_frame(chunks)
+        duration = 5.0 if count > 1000 else 1.0
+        legacy = timeit(lambda: legacy_frame(chunks), duration) * count
+        framer = timeit(lambda: framer_frame(chunks), duration) * count
+        print 'framing %5d lines: legacy %10.0f lines/s, framer %10.0f lines/s' % (
+            count, legacy, framer)
+
+STORAGE_PROFILES = [
+    ('legacy', dict(journal_mode='delete', synchronous='full',
+        cache_size=2 * 1024 * 1024, mmap_size=0,
+        commit_interval=5, commit_operations=0)),
+    ('durable', dict(journal_mode='wal', synchronous='full',
+        cache_size=64 * 1024 * 1024, mmap_size=0,
+        commit_interval=None, commit_operations=1)),
+    ('balanced', dict(journal_mode='wal', synchronous='normal',
+        cache_size=64 * 1024 * 1024, mmap_size=256 * 1024 * 1024,
+        commit_interval=5, commit_operations=0)),
+    ('bulk', dict(journal_mode='wal', synchronous='normal',
+        cache_size=64 * 1024 * 1024, mmap_size=256 * 1024 * 1024,
+        commit_interval=None, commit_operations=10000)),
+    ('unsafe', dict(journal_mode='wal', synchronous='off',
+        cache_size=256 * 1024 * 1024, mmap_size=256 * 1024 * 1024,
+        commit_interval=30, commit_operations=0)),
+]
+
+def bench_storage(count=20000):
+    query = (
+        'insert or replace into block (p, q, x, y, z, w) '
+        'values (?, ?, ?, ?, ?, ?);'
+    )
+    rand = random.Random(0)
+    blocks = [(rand.randint(-256, 255), rand.randint(1, 255),
+        rand.randint(-256, 255), rand.randint(1, 63)) for _ in range(count)]
+    for name, profile in STORAGE_PROFILES:
+        path = tempfile.mktemp(suffix='.db')
+        try:
+            storage = Storage(path, **profile)
+            storage.execute(
+                'create table block (p int not null, q int not null, '
+                'x int not null, y int not null, z int not null, '
+                'w int not null);')
+            storage.execute(
+                'create unique index block_pqxyz_idx on '
+                'block (p, q, x, y, z);')
+            storage.commit()
+            start = time.time()
+            for x, y, z, w in blocks:
+                storage.execute(query, (x // 32, z // 32, x, y, z, w))
+                if storage.commit_due():
+                    storage.commit()
+            storage.commit()
+            elapsed = time.time() - start
+            storage.close()
+        finally:
+            for suffix in ('', '-wal', '-shm', '-journal'):
+                if os.path.exists(path + suffix):
+                    os.remove(path + suffix)
+        print 'storage %-8s %10.0f blocks/s' % (name, count / elapsed)
+
+def bench_world():
+    from ctypes import CFUNCTYPE, c_int, c_void_p
+    import world
+    world_func = CFUNCTYPE(None, c_int, c_int, c_int, c_int, c_void_p)
+    def legacy_create_world(p, q):
+        result = {}
+        def func(x, y, z, w, arg):
+            result[(x, y, z)] = w
+        world.dll.create_world(p, q, world_func(func), None)
+        return result
+    chunks = iter(range(1000000))
+    legacy = timeit(lambda: legacy_create_world(next(chunks), 0), 2.0)
+    volume = timeit(lambda: world.dll_create_world(next(chunks), 0), 2.0)
+    print 'world: callback %6.1f chunks/s, volume %6.1f chunks/s' % (
+        legacy, volume)
+    generator = world.World()
+    count = generator.workers * 16
+    start = time.time()
+    for chunk in generator.generate_many((i, 1) for i in range(count)):
+        pass
+    print 'world: generate_many %6.1f chunks/s on %d workers' % (
+        count / (time.time() - start), generator.workers)
+
+BENCHMARKS = {
+    'framing': bench_framing,
+    'storage': bench_storage,
+    'world': bench_world,
+}
+
+def main():
+    names = sys.argv[1:] or sorted(BENCHMARKS)
+    for name in names:
+        BENCHMARKS[name]()
+
+if __name__ == '__main__':
+    main()
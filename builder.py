@@ -1,6 +1,7 @@
 # This file allows you to programmatically create blocks in Craft.
 # Please use this wisely. Test on your own server first. Do not abuse it.
 
+from framing import LineFramer
 import requests
 import socket
 import sqlite3
@@ -8,6 +9,9 @@ import sys
 
 DEFAULT_HOST = '127.0.0.1'
 DEFAULT_PORT = 4080
+BUFFER_SIZE = 4096
+BULK_SIZE = 256
+CHUNK_SIZE = 32
 
 EMPTY = 0
 GRASS = 1
@@ -143,6 +147,7 @@ class Client(object):
     def __init__(self, host, port):
         self.conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.conn.connect((host, port))
+        self.framer = LineFramer()
         self.authenticate()
     def authenticate(self):
         username, identity_token = get_identity()
@@ -157,12 +162,25 @@ class Client(object):
             self.conn.sendall('A,%s,%s\n' % (username, access_token))
         else:
             raise Exception('Failed to authenticate.')
+    def recv(self):
+        data = self.conn.recv(BUFFER_SIZE)
+        if not data:
+            raise Exception('Connection closed by server.')
+        return self.framer.feed(data)
     def set_block(self, x, y, z, w):
         self.conn.sendall('B,%d,%d,%d,%d\n' % (x, y, z, w))
     def set_blocks(self, blocks, w):
-        key = lambda block: (block[1], block[0], block[2])
-        for x, y, z in sorted(blocks, key=key):
-            self.set_block(x, y, z, w)
+        # one bulk command per BULK_SIZE blocks of the same chunk
+        chunks = {}
+        for x, y, z in blocks:
+            key = (x // CHUNK_SIZE, z // CHUNK_SIZE)
+            chunks.setdefault(key, []).append((x, y, z))
+        for key in sorted(chunks):
+            chunk = sorted(chunks[key], key=lambda block: block[1])
+            for i in range(0, len(chunk), BULK_SIZE):
+                coords = ','.join('%d,%d,%d' % block
+                    for block in chunk[i:i + BULK_SIZE])
+                self.conn.sendall('M,%d,%s\n' % (w, coords))
     def bitmap(self, sx, sy, sz, d1, d2, data, lookup):
         x, y, z = sx, sy, sz
         dx1, dy1, dz1 = d1
@@ -0,0 +1,37 @@
+from collections import OrderedDict
+
+class LRUCache(object):
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.size = 0
+    def __len__(self):
+        return len(self.entries)
+    def __contains__(self, key):
+        return key in self.entries
+    def get(self, key, default=None):
+        try:
+            entry = self.entries.pop(key)
+        except KeyError:
+            return default
+        self.entries[key] = entry
+        return entry[0]
+    def set(self, key, value, size=1):
+        # size is in whatever unit capacity is measured in; the newest
+        # entry is always kept even if it alone exceeds the capacity
+        self.pop(key)
+        self.entries[key] = (value, size)
+        self.size += size
+        while self.size > self.capacity and len(self.entries) > 1:
+            _, (_, evicted) = self.entries.popitem(False)
+            self.size -= evicted
+    def pop(self, key, default=None):
+        try:
+            value, size = self.entries.pop(key)
+        except KeyError:
+            return default
+        self.size -= size
+        return value
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
@@ -109,24 +109,28 @@ static unsigned char PERM[] = {
     128, 195,  78,  66, 215,  61, 156, 180
 };
 
-void seed(unsigned int x) {
+void seed_state(unsigned char *perm, unsigned int x) {
     srand(x);
     for (int i = 0; i < 256; i++) {
-        PERM[i] = i;
+        perm[i] = i;
     }
     for (int i = 255; i > 0; i--) {
         int j;
         int n = i + 1;
         while (n <= (j = rand() / (RAND_MAX / n)));
-        unsigned char a = PERM[i];
-        unsigned char b = PERM[j];
-        PERM[i] = b;
-        PERM[j] = a;
+        unsigned char a = perm[i];
+        unsigned char b = perm[j];
+        perm[i] = b;
+        perm[j] = a;
     }
-    memcpy(PERM + 256, PERM, sizeof(unsigned char) * 256);
+    memcpy(perm + 256, perm, sizeof(unsigned char) * 256);
+}
+
+void seed(unsigned int x) {
+    seed_state(PERM, x);
 }
 
-float noise2(float x, float y) {
+float noise2(const unsigned char *perm, float x, float y) {
     int i1, j1, I, J, c;
     float s = (x + y) * F2;
     float i = floorf(x + s);
@@ -150,9 +154,9 @@ float noise2(float x, float y) {
 
     I = (int) i & 255;
     J = (int) j & 255;
-    g[0] = PERM[I + PERM[J]] % 12;
-    g[1] = PERM[I + i1 + PERM[J + j1]] % 12;
-    g[2] = PERM[I + 1 + PERM[J + 1]] % 12;
+    g[0] = perm[I + perm[J]] % 12;
+    g[1] = perm[I + i1 + perm[J + j1]] % 12;
+    g[2] = perm[I + 1 + perm[J + 1]] % 12;
 
     for (c = 0; c <= 2; c++) {
         f[c] = 0.5f - xx[c]*xx[c] - yy[c]*yy[c];
@@ -168,7 +172,7 @@ float noise2(float x, float y) {
     return (noise[0] + noise[1] + noise[2]) * 70.0f;
 }
 
-float noise3(float x, float y, float z) {
+float noise3(const unsigned char *perm, float x, float y, float z) {
     int c, o1[3], o2[3], g[4], I, J, K;
     float f[4], noise[4] = {0.0f, 0.0f, 0.0f, 0.0f};
     float s = (x + y + z) * F3;
@@ -216,10 +220,10 @@ float noise3(float x, float y, float z) {
     I = (int) i & 255; 
     J = (int) j & 255; 
     K = (int) k & 255;
-    g[0] = PERM[I + PERM[J + PERM[K]]] % 12;
-    g[1] = PERM[I + o1[0] + PERM[J + o1[1] + PERM[o1[2] + K]]] % 12;
-    g[2] = PERM[I + o2[0] + PERM[J + o2[1] + PERM[o2[2] + K]]] % 12;
-    g[3] = PERM[I + 1 + PERM[J + 1 + PERM[K + 1]]] % 12; 
+    g[0] = perm[I + perm[J + perm[K]]] % 12;
+    g[1] = perm[I + o1[0] + perm[J + o1[1] + perm[o1[2] + K]]] % 12;
+    g[2] = perm[I + o2[0] + perm[J + o2[1] + perm[o2[2] + K]]] % 12;
+    g[3] = perm[I + 1 + perm[J + 1 + perm[K + 1]]] % 12; 
 
     for (c = 0; c <= 3; c++) {
         f[c] = 0.6f - pos[c][0] * pos[c][0] - pos[c][1] * pos[c][1] -
@@ -235,38 +239,59 @@ float noise3(float x, float y, float z) {
     return (noise[0] + noise[1] + noise[2] + noise[3]) * 32.0f;
 }
 
-float simplex2(
-    float x, float y,
+float simplex2_state(
+    const unsigned char *perm, float x, float y,
     int octaves, float persistence, float lacunarity)
 {
+    if (!perm) {
+        perm = PERM;
+    }
     float freq = 1.0f;
     float amp = 1.0f;
     float max = 1.0f;
-    float total = noise2(x, y);
+    float total = noise2(perm, x, y);
     int i;
     for (i = 1; i < octaves; i++) {
         freq *= lacunarity;
         amp *= persistence;
         max += amp;
-        total += noise2(x * freq, y * freq) * amp;
+        total += noise2(perm, x * freq, y * freq) * amp;
     }
     return (1 + total / max) / 2;
 }
 
-float simplex3(
-    float x, float y, float z,
+float simplex3_state(
+    const unsigned char *perm, float x, float y, float z,
     int octaves, float persistence, float lacunarity)
 {
+    if (!perm) {
+        perm = PERM;
+    }
     float freq = 1.0f;
     float amp = 1.0f;
     float max = 1.0f;
-    float total = noise3(x, y, z);
+    float total = noise3(perm, x, y, z);
     int i;
     for (i = 1; i < octaves; ++i) {
         freq *= lacunarity;
         amp *= persistence;
         max += amp;
-        total += noise3(x * freq, y * freq, z * freq) * amp;
+        total += noise3(perm, x * freq, y * freq, z * freq) * amp;
     }
     return (1 + total / max) / 2;
 }
+
+float simplex2(
+    float x, float y,
+    int octaves, float persistence, float lacunarity)
+{
+    return simplex2_state(PERM, x, y, octaves, persistence, lacunarity);
+}
+
+float simplex3(
+    float x, float y, float z,
+    int octaves, float persistence, float lacunarity)
+{
+    return simplex3_state(
+        PERM, x, y, z, octaves, persistence, lacunarity);
+}
@@ -37,4 +37,17 @@ float simplex3(
     float x, float y, float z,
     int octaves, float persistence, float lacunarity);
 
+// reentrant variants: perm is a 512 byte permutation table filled by
+// seed_state, or NULL for the default table used by the functions above
+
+void seed_state(unsigned char *perm, unsigned int x);
+
+float simplex2_state(
+    const unsigned char *perm, float x, float y,
+    int octaves, float persistence, float lacunarity);
+
+float simplex3_state(
+    const unsigned char *perm, float x, float y, float z,
+    int octaves, float persistence, float lacunarity);
+
 #endif
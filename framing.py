@@ -0,0 +1,31 @@
+MAX_LINE_LENGTH = 65536
+
+class LineFramer(object):
+    def __init__(self, max_length=MAX_LINE_LENGTH):
+        self.buf = bytearray()
+        self.scan = 0
+        self.max_length = max_length
+    def feed(self, data):
+        # returns the complete, non-empty lines in data; the scan offset
+        # ensures each byte is searched for a newline only once
+        buf = self.buf
+        buf.extend(data)
+        lines = []
+        start = 0
+        index = buf.find('\n', self.scan)
+        if index >= 0:
+            view = memoryview(buf)
+            while index >= 0:
+                end = index
+                if end > start and buf[end - 1] == 13:
+                    end -= 1
+                if end > start:
+                    lines.append(view[start:end].tobytes())
+                start = index + 1
+                index = buf.find('\n', start)
+            del view
+            del buf[:start]
+        self.scan = len(buf)
+        if self.scan > self.max_length:
+            raise ValueError('line exceeds %d bytes' % self.max_length)
+        return lines
@@ -0,0 +1,60 @@
+import time
+
+# histogram bucket upper bounds in seconds
+BUCKETS = (0.0001, 0.001, 0.01, 0.1, 1.0, float('inf'))
+
+class Histogram(object):
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+        for index, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.counts[index] += 1
+                break
+    def format(self):
+        buckets = ' '.join('%s:%d' % (format_seconds(bound), count)
+            for bound, count in zip(BUCKETS, self.counts) if count)
+        return 'count=%d mean=%s max=%s %s' % (self.count,
+            format_seconds(self.total / self.count),
+            format_seconds(self.max), buckets)
+
+def format_seconds(seconds):
+    if seconds == float('inf'):
+        return 'inf'
+    if seconds < 0.001:
+        return '%.0fus' % (seconds * 1000000)
+    if seconds < 1:
+        return '%.1fms' % (seconds * 1000)
+    return '%.2fs' % seconds
+
+class Metrics(object):
+    # counters and latency histograms by name; written by the Model thread
+    # only, so reports from other threads may be slightly out of date
+    def __init__(self):
+        self.started = time.time()
+        self.counters = {}
+        self.histograms = {}
+    def incr(self, name, count=1):
+        self.counters[name] = self.counters.get(name, 0) + count
+    def observe(self, name, seconds):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        histogram.add(seconds)
+    def report(self, gauges=()):
+        # gauges are extra (name, value) pairs sampled by the caller
+        lines = ['uptime %.0f' % (time.time() - self.started)]
+        for name, value in gauges:
+            lines.append('%s %s' % (name, value))
+        for name, value in sorted(self.counters.items()):
+            lines.append('%s %d' % (name, value))
+        for name, histogram in sorted(self.histograms.items()):
+            lines.append('%s %s' % (name, histogram.format()))
+        return lines
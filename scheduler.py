@@ -0,0 +1,87 @@
+from collections import OrderedDict, deque
+import itertools
+import threading
+
+RANK_WINDOW = 64
+
+class Scheduler(object):
+    # priority classes are served strictly in order; a fair class keeps
+    # work per owner and serves owners round robin, the others are plain
+    # fifos; work put with a key replaces the owner's pending work with
+    # the same key in place; a ranked class serves the owner's lowest
+    # ranked item among the oldest RANK_WINDOW instead of the oldest
+    def __init__(self, fair, rank=None):
+        self.fair = fair
+        self.rank = rank or {}
+        self.owners = [deque() for _ in fair]
+        self.pending = [{} for _ in fair]
+        self.condition = threading.Condition()
+        self.counter = itertools.count()
+    def put(self, priority, owner, key, item):
+        if not self.fair[priority]:
+            owner = None
+        if key is None:
+            key = next(self.counter)
+        with self.condition:
+            pending = self.pending[priority]
+            if owner not in pending:
+                pending[owner] = OrderedDict()
+                self.owners[priority].append(owner)
+            pending[owner][key] = item
+            self.condition.notify()
+    def get(self, timeout=None):
+        # returns (priority, item), or None if nothing arrived in time
+        with self.condition:
+            result = self.pop()
+            if result is None:
+                self.condition.wait(timeout)
+                result = self.pop()
+            return result
+    def pop(self):
+        for priority, owners in enumerate(self.owners):
+            if not owners:
+                continue
+            owner = owners.popleft()
+            work = self.pending[priority][owner]
+            rank = self.rank.get(priority)
+            if rank is None:
+                _, item = work.popitem(False)
+            else:
+                window = itertools.islice(work, RANK_WINDOW)
+                item = work.pop(min(window, key=lambda x: rank(owner, x)))
+            if work:
+                owners.append(owner)
+            else:
+                del self.pending[priority][owner]
+            return priority, item
+        return None
+    def discard(self, owner, priorities=None, match=None):
+        # drops the pending work of owner in the given fair classes, or
+        # only the items whose key satisfies match, returning how many
+        # items were dropped
+        count = 0
+        with self.condition:
+            for priority, fair in enumerate(self.fair):
+                if not fair or (priorities and priority not in priorities):
+                    continue
+                work = self.pending[priority].get(owner)
+                if work is None:
+                    continue
+                if match is not None:
+                    for key in [x for x in work if match(x)]:
+                        del work[key]
+                        count += 1
+                    if work:
+                        continue
+                else:
+                    count += len(work)
+                del self.pending[priority][owner]
+                self.owners[priority].remove(owner)
+        return count
+    def sizes(self):
+        # the number of pending items in each class
+        with self.condition:
+            return [sum(len(work) for work in pending.itervalues())
+                for pending in self.pending]
+    def __len__(self):
+        return sum(self.sizes())
@@ -1,16 +1,28 @@
-from math import floor
+from auth import Authenticator, HttpBackend, SqliteBackend
+from cache import LRUCache
+from framing import LineFramer
+from math import cos, floor, hypot, pi, sin
+from metrics import Metrics
+from scheduler import Scheduler
+from storage import Storage
 from world import World
+import BaseHTTPServer
 import Queue
 import SocketServer
+import base64
 import datetime
+import errno
+import os
 import random
 import re
-import requests
-import sqlite3
+import select
+import socket
+import struct
 import sys
 import threading
 import time
 import traceback
+import zlib
 
 DEFAULT_HOST = '0.0.0.0'
 DEFAULT_PORT = 4080
@@ -21,10 +33,36 @@ LOG_PATH = 'log.txt'
 CHUNK_SIZE = 32
 BUFFER_SIZE = 4096
 COMMIT_INTERVAL = 5
+COMMIT_OPERATIONS = 0
+SQLITE_JOURNAL_MODE = 'wal'
+SQLITE_SYNCHRONOUS = 'normal'
+SQLITE_CACHE_SIZE = 64 * 1024 * 1024
+SQLITE_MMAP_SIZE = 256 * 1024 * 1024
+BLOCK_CACHE_SIZE = 1000000
+CHUNK_CACHE_BYTES = 64 * 1024 * 1024
+WORLD_CACHE_BYTES = 256 * 1024 * 1024
+CHUNK_READERS = 2
+STATS_INTERVAL = 60
+METRICS = False
+STATS_HOST = '127.0.0.1'
+STATS_PORT = None
+ADMIN_USER_IDS = set()
+STATS_CLIENTS = 10
+TICK_RATE = 10
+EVENT_LOOP = False
 
 DAY_LENGTH = 600
+VIEW_RADIUS = 28
+CHUNK_HEADING_BIAS = 0.5
+PREFETCH_RADIUS = 0
+PLAYER_VIEW_RADIUS = 12
 SPAWN_POINT = (0, 0, 0, 0, 0)
+WORLD_STORE_PATH = None
+PREWARM_RADIUS = 16
+CLEANUP_BATCH_SIZE = 64
+CLEANUP_REPORT_INTERVAL = 10
 RATE_LIMIT = False
+BULK_SIZE = 256
 RECORD_HISTORY = False
 INDESTRUCTIBLE_ITEMS = set([16])
 ALLOWED_ITEMS = set([
@@ -35,8 +73,10 @@ ALLOWED_ITEMS = set([
 
 AUTHENTICATE = 'A'
 BLOCK = 'B'
+BULK = 'M'
 CHUNK = 'C'
 DISCONNECT = 'D'
+FRAME = 'F'
 KEY = 'K'
 LIGHT = 'L'
 NICK = 'N'
@@ -47,6 +87,30 @@ TALK = 'T'
 TIME = 'E'
 VERSION = 'V'
 YOU = 'U'
+ZLIB = 'Z'
+
+# Model work classes, served in this order
+INTERACTIVE = 0
+MOVEMENT = 1
+TRANSFER = 2
+
+# version 2 clients receive chunk contents as binary frames, version 3
+# clients also accept compressed send batches
+PROTOCOL_VERSION = 3
+BINARY_VERSION = 2
+COMPRESS_VERSION = 3
+FRAME_COMPRESSION = 6
+FRAME_COMPRESS_MIN = 128
+COMPRESSION_LEVEL = 6
+COMPRESS_MIN = 256
+COMPRESS_SLICE = 64 * 1024
+OUTBOX_SOFT_LIMIT = 1024 * 1024
+OUTBOX_HARD_LIMIT = 16 * 1024 * 1024
+AUTH_BACKEND = 'http'
+AUTH_URL = 'https://craft.michaelfogleman.com/api/1/access'
+AUTH_DB_PATH = 'auth.db'
+AUTH_WORKERS = 4
+AUTH_CACHE_TTL = 300
 
 try:
     from config import *
@@ -63,16 +127,151 @@ def log(*args):
 def chunked(x):
     return int(floor(round(x) / CHUNK_SIZE))
 
+REDRAW_PATTERN = re.compile(r'^R,-?\d+,-?\d+\n', re.M)
+POSITION_PATTERN = re.compile(r'^P,(-?\d+),.*\n', re.M)
+
 def packet(*args):
     return '%s\n' % ','.join(map(str, args))
 
+def coalesce_redraws(data):
+    # drops all but the last R,p,q line of each chunk, so every change is
+    # still followed by exactly one redraw of its chunk
+    return keep_last(data, REDRAW_PATTERN, 0)
+
+def coalesce_positions(data):
+    # drops all but the last P line of each player
+    return keep_last(data, POSITION_PATTERN, 1)
+
+def keep_last(data, pattern, group):
+    # drops every match of pattern but the last one with the same group
+    matches = list(pattern.finditer(data))
+    if len(matches) < 2:
+        return data
+    seen = set()
+    drop = []
+    for match in reversed(matches):
+        line = match.group(group)
+        if line in seen:
+            drop.append(match)
+        else:
+            seen.add(line)
+    if not drop:
+        return data
+    result = []
+    start = 0
+    for match in reversed(drop):
+        result.append(data[start:match.start()])
+        start = match.end()
+    result.append(data[start:])
+    return ''.join(result)
+
+def open_storage(readonly=False):
+    # chunk readers hold read locks that would block commits under a
+    # rollback journal, so they always get WAL
+    journal_mode = 'wal' if CHUNK_READERS else SQLITE_JOURNAL_MODE
+    return Storage(DB_PATH,
+        journal_mode=journal_mode,
+        synchronous=SQLITE_SYNCHRONOUS,
+        cache_size=SQLITE_CACHE_SIZE,
+        mmap_size=SQLITE_MMAP_SIZE,
+        commit_interval=COMMIT_INTERVAL,
+        commit_operations=COMMIT_OPERATIONS,
+        readonly=readonly)
+
+def open_authenticator():
+    if AUTH_BACKEND == 'sqlite':
+        backend = SqliteBackend(AUTH_DB_PATH)
+    else:
+        backend = HttpBackend(AUTH_URL)
+    return Authenticator(backend, AUTH_WORKERS, AUTH_CACHE_TTL)
+
+FRAME_HEADER = struct.Struct('<iiBI')
+FRAME_COUNTS = struct.Struct('<HHH')
+FRAME_BLOCK = struct.Struct('<BBBb')
+FRAME_SIGN = struct.Struct('<BBBBB')
+FRAME_COMPRESSED = 1
+
+def encode_frame(p, q, blocks, lights, signs):
+    # F,<base64> carrying the header (p, q, flags, body size) and a body of
+    # the three counts followed by blocks and lights as chunk relative
+    # (x + 1, z + 1, y, w) and signs as (x + 1, z + 1, y, face, length,
+    # text); returns None when a row does not fit the packed layout
+    x0, z0 = p * CHUNK_SIZE - 1, q * CHUNK_SIZE - 1
+    if max(len(blocks), len(lights), len(signs)) > 0xffff:
+        return None
+    body = [FRAME_COUNTS.pack(len(blocks), len(lights), len(signs))]
+    try:
+        for x, y, z, w in blocks:
+            body.append(FRAME_BLOCK.pack(x - x0, z - z0, y, w))
+        for x, y, z, w in lights:
+            body.append(FRAME_BLOCK.pack(x - x0, z - z0, y, w))
+        for x, y, z, face, text in signs:
+            text = text.encode('utf-8')
+            body.append(FRAME_SIGN.pack(x - x0, z - z0, y, face, len(text)))
+            body.append(text)
+    except struct.error:
+        return None
+    body = ''.join(body)
+    flags = 0
+    size = len(body)
+    if FRAME_COMPRESSION and size >= FRAME_COMPRESS_MIN:
+        flags |= FRAME_COMPRESSED
+        body = zlib.compress(body, FRAME_COMPRESSION)
+    data = FRAME_HEADER.pack(p, q, flags, size) + body
+    return packet(FRAME, base64.b64encode(data))
+
+def serialize_chunk(execute, p, q, key, blocks=None, binary=False):
+    # blocks, if given, are the (rowid, x, y, z, w) rows newer than key;
+    # key covers block, light and sign rows, which share one sequence
+    packets = []
+    if blocks is None:
+        query = (
+            'select rowid, x, y, z, w from block where '
+            'p = ? and q = ? and rowid > ?;'
+        )
+        blocks = execute(query, (p, q, key))
+    blocks = list(blocks)
+    query = (
+        'select rowid, x, y, z, w from light where '
+        'p = ? and q = ? and rowid > ?;'
+    )
+    lights = list(execute(query, (p, q, key)))
+    query = (
+        'select rowid, x, y, z, face, text from sign where '
+        'p = ? and q = ? and rowid > ?;'
+    )
+    signs = list(execute(query, (p, q, key)))
+    max_rowid = max([row[0] for row in blocks + lights + signs] or [0])
+    blocks = [row[1:] for row in blocks]
+    lights = [row[1:] for row in lights]
+    signs = [row[1:] for row in signs]
+    frame = None
+    if binary and (blocks or lights or signs):
+        frame = encode_frame(p, q, blocks, lights, signs)
+    if frame is not None:
+        packets.append(frame)
+    else:
+        for x, y, z, w in blocks:
+            packets.append(packet(BLOCK, p, q, x, y, z, w))
+        for x, y, z, w in lights:
+            packets.append(packet(LIGHT, p, q, x, y, z, w))
+        for x, y, z, face, text in signs:
+            text = text.encode('utf-8')
+            packets.append(packet(SIGN, p, q, x, y, z, face, text))
+    if max_rowid:
+        packets.append(packet(KEY, p, q, max_rowid))
+    if blocks or lights or signs:
+        packets.append(packet(REDRAW, p, q))
+    packets.append(packet(CHUNK, p, q))
+    return ''.join(packets)
+
 class RateLimiter(object):
     def __init__(self, rate, per):
         self.rate = float(rate)
         self.per = float(per)
         self.allowance = self.rate
         self.last_check = time.time()
-    def tick(self):
+    def tick(self, count=1):
         if not RATE_LIMIT:
             return False
         now = time.time()
@@ -81,59 +280,164 @@ class RateLimiter(object):
         self.allowance += elapsed * (self.rate / self.per)
         if self.allowance > self.rate:
             self.allowance = self.rate
-        if self.allowance < 1:
+        if self.allowance < count:
             return True # too fast
         else:
-            self.allowance -= 1
+            self.allowance -= count
             return False # okay
 
 class Server(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
     allow_reuse_address = True
     daemon_threads = True
 
-class Handler(SocketServer.BaseRequestHandler):
+class Connection(object):
     def setup(self):
         self.position_limiter = RateLimiter(100, 5)
         self.limiter = RateLimiter(1000, 10)
+        self.output_lock = threading.Lock()
+        self.outbox = []
+        self.queued = 0
+        self.compacted = 0
+        self.peak_queued = 0
+        self.dropped = 0
+        self.overflowed = False
+        self.bytes_in = 0
+        self.bytes_out = 0
         self.version = None
+        self.binary = False
+        self.compression = 0
+        self.compressor = None
+        self.batches = 0
+        self.compress_after = 0
         self.client_id = None
         self.user_id = None
         self.nick = None
-        self.queue = Queue.Queue()
+        self.held = None
+        self.framer = LineFramer()
+    def on_recv(self, data):
+        self.bytes_in += len(data)
+        try:
+            lines = self.framer.feed(data)
+        except ValueError:
+            log('LONG', self.client_id)
+            return False
+        for line in lines:
+            if not self.on_line(line):
+                return False
+        return True
+    def on_line(self, line):
+        if line[0] == POSITION:
+            if self.position_limiter.tick():
+                log('RATE', self.client_id)
+                return False
+        else:
+            # bulk edits are charged per block
+            count = 1
+            if line[0] == BULK:
+                count = max(1, line.count(',') // 3)
+            if self.limiter.tick(count):
+                log('RATE', self.client_id)
+                return False
+        model = self.server.model
+        model.enqueue_data(self, line)
+        return True
+    def send(self, *args):
+        self.send_raw(packet(*args))
+    def send_raw(self, data):
+        if not data:
+            return
+        with self.output_lock:
+            if self.overflowed:
+                return
+            self.outbox.append(data)
+            self.queued += len(data)
+            if self.queued > max(OUTBOX_SOFT_LIMIT, 2 * self.compacted):
+                self.compact()
+            self.peak_queued = max(self.peak_queued, self.queued)
+            if self.queued > OUTBOX_HARD_LIMIT:
+                log('SLOW', self.client_id, self.queued)
+                self.overflowed = True
+                self.outbox = []
+                self.queued = 0
+        if self.overflowed:
+            self.stop()
+        else:
+            self.notify()
+    def compact(self):
+        # called with output_lock held once a slow client's backlog passes
+        # the soft limit; only the latest position of each player and one
+        # redraw per chunk are worth sending
+        data = coalesce_redraws(coalesce_positions(''.join(self.outbox)))
+        self.dropped += self.queued - len(data)
+        self.outbox = [data]
+        self.queued = self.compacted = len(data)
+    def take_output(self):
+        with self.output_lock:
+            data = ''.join(self.outbox)
+            self.outbox = []
+            self.queued = self.compacted = 0
+            self.batches += 1
+            if self.compression and self.compressor is None:
+                if self.batches > self.compress_after:
+                    self.compressor = zlib.compressobj(self.compression)
+        return data
+    def start_compression(self, level):
+        # called right after queueing the version reply, which the client
+        # must see uncompressed; the next batch taken may carry it, so the
+        # one after that is the first compressed
+        with self.output_lock:
+            self.compression = level
+            self.compress_after = self.batches + 1
+    def encode(self, data):
+        # called by the sender with each batch; batches of at least
+        # COMPRESS_MIN bytes go out as Z,<base64> lines, each holding the
+        # next sync flushed segment of the connection's deflate stream for
+        # at most COMPRESS_SLICE bytes of whole lines, so every Z line
+        # fits the client's receive queue
+        data = coalesce_redraws(data)
+        compressor = self.compressor
+        if compressor is None or len(data) < COMPRESS_MIN:
+            return data
+        result = []
+        start = 0
+        while start < len(data):
+            end = data.rfind('\n', start, start + COMPRESS_SLICE) + 1
+            if end <= start:
+                end = data.find('\n', start) + 1 or len(data)
+            body = compressor.compress(data[start:end])
+            body += compressor.flush(zlib.Z_SYNC_FLUSH)
+            result.append(packet(ZLIB, base64.b64encode(body)))
+            start = end
+        return ''.join(result)
+
+class Handler(SocketServer.BaseRequestHandler, Connection):
+    def setup(self):
+        Connection.setup(self)
+        self.ready = threading.Event()
         self.running = True
         self.start()
     def handle(self):
         model = self.server.model
         model.enqueue(model.on_connect, self)
         try:
-            buf = []
             while True:
                 data = self.request.recv(BUFFER_SIZE)
                 if not data:
                     break
-                buf.extend(data.replace('\r\n', '\n'))
-                while '\n' in buf:
-                    index = buf.index('\n')
-                    line = ''.join(buf[:index])
-                    buf = buf[index + 1:]
-                    if not line:
-                        continue
-                    if line[0] == POSITION:
-                        if self.position_limiter.tick():
-                            log('RATE', self.client_id)
-                            self.stop()
-                            return
-                    else:
-                        if self.limiter.tick():
-                            log('RATE', self.client_id)
-                            self.stop()
-                            return
-                    model.enqueue(model.on_data, self, line)
+                if not self.on_recv(data):
+                    self.stop()
+                    return
         finally:
             model.enqueue(model.on_disconnect, self)
     def finish(self):
         self.running = False
+        self.ready.set()
     def stop(self):
+        # close alone does not wake a recv blocked in the handler thread
+        try:
+            self.request.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
         self.request.close()
     def start(self):
         thread = threading.Thread(target=self.run)
@@ -142,36 +446,220 @@ class Handler(SocketServer.BaseRequestHandler):
     def run(self):
         while self.running:
             try:
-                buf = []
-                try:
-                    buf.append(self.queue.get(timeout=5))
-                    try:
-                        while True:
-                            buf.append(self.queue.get(False))
-                    except Queue.Empty:
-                        pass
-                except Queue.Empty:
+                self.ready.wait(5)
+                self.ready.clear()
+                data = self.take_output()
+                if not data:
                     continue
-                data = ''.join(buf)
+                data = self.encode(data)
                 self.request.sendall(data)
+                self.bytes_out += len(data)
             except Exception:
                 self.request.close()
                 raise
-    def send_raw(self, data):
-        if data:
-            self.queue.put(data)
-    def send(self, *args):
-        self.send_raw(packet(*args))
+    def notify(self):
+        self.ready.set()
+
+class EventServer(object):
+    def __init__(self, server_address):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(server_address)
+        self.socket.listen(128)
+        self.socket.setblocking(0)
+        self.poller = select.poll()
+        self.handlers = {}
+        self.lock = threading.Lock()
+        self.dirty = set()
+        self.waking = False
+        self.wake_r, self.wake_w = os.pipe()
+        self.poller.register(self.socket.fileno(), select.POLLIN)
+        self.poller.register(self.wake_r, select.POLLIN)
+    def wake(self, handler):
+        # called from any thread when handler has output or must be closed
+        with self.lock:
+            self.dirty.add(handler)
+            if self.waking:
+                return
+            self.waking = True
+        os.write(self.wake_w, 'x')
+    def serve_forever(self):
+        while True:
+            events = self.poller.poll()
+            for fd, event in events:
+                if fd == self.wake_r:
+                    self.handle_wake()
+                elif fd == self.socket.fileno():
+                    self.handle_accept()
+                else:
+                    handler = self.handlers.get(fd)
+                    if handler is not None:
+                        self.handle_event(handler, event)
+    def handle_wake(self):
+        os.read(self.wake_r, BUFFER_SIZE)
+        with self.lock:
+            dirty = self.dirty
+            self.dirty = set()
+            self.waking = False
+        for handler in dirty:
+            if handler.closed:
+                continue
+            if handler.stopping:
+                self.close(handler)
+            else:
+                self.poller.modify(
+                    handler.fileno, select.POLLIN | select.POLLOUT)
+    def handle_accept(self):
+        while True:
+            try:
+                request, client_address = self.socket.accept()
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+            handler = EventHandler(self, request, client_address)
+            self.handlers[handler.fileno] = handler
+            self.poller.register(handler.fileno, select.POLLIN)
+            self.model.enqueue(self.model.on_connect, handler)
+    def handle_event(self, handler, event):
+        try:
+            if event & (select.POLLIN | select.POLLHUP | select.POLLERR):
+                if not handler.handle_read():
+                    self.close(handler)
+                    return
+            if event & select.POLLOUT:
+                if not handler.handle_write():
+                    self.poller.modify(handler.fileno, select.POLLIN)
+        except socket.error:
+            self.close(handler)
+    def close(self, handler):
+        if handler.closed:
+            return
+        handler.closed = True
+        self.poller.unregister(handler.fileno)
+        del self.handlers[handler.fileno]
+        handler.request.close()
+        self.model.enqueue(self.model.on_disconnect, handler)
+
+class EventHandler(Connection):
+    def __init__(self, server, request, client_address):
+        self.server = server
+        self.request = request
+        self.client_address = client_address
+        self.fileno = request.fileno()
+        self.request.setblocking(0)
+        self.setup()
+        self.pending = ''
+        self.stopping = False
+        self.closed = False
+    def handle_read(self):
+        try:
+            data = self.request.recv(BUFFER_SIZE)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return True
+            raise
+        if not data:
+            return False
+        return self.on_recv(data)
+    def handle_write(self):
+        # returns True while there is still output pending
+        if not self.pending:
+            self.pending = self.encode(self.take_output())
+            if not self.pending:
+                return False
+        try:
+            count = self.request.send(self.pending)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return True
+            raise
+        self.bytes_out += count
+        self.pending = self.pending[count:]
+        if self.pending:
+            return True
+        with self.output_lock:
+            return bool(self.outbox)
+    def stop(self):
+        self.stopping = True
+        self.server.wake(self)
+    def notify(self):
+        self.server.wake(self)
+
+class LatencyStats(object):
+    def __init__(self, name):
+        self.name = name
+        self.reset()
+    def reset(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+    def flush(self):
+        if self.count:
+            log('WAIT', self.name, self.count,
+                '%.1fms' % (self.total / self.count * 1000),
+                '%.1fms' % (self.max * 1000))
+        self.reset()
+
+class ChunkReader(object):
+    # serves chunk requests from read-only connections; results are posted
+    # back to the Model thread, which decides whether they are still fresh
+    def __init__(self, model, count):
+        self.model = model
+        self.queue = Queue.Queue()
+        for _ in range(count):
+            thread = threading.Thread(target=self.run)
+            thread.setDaemon(True)
+            thread.start()
+    def read(self, p, q, key, binary):
+        self.queue.put((time.time(), p, q, key, binary))
+    def run(self):
+        storage = open_storage(readonly=True)
+        while True:
+            queued, p, q, key, binary = self.queue.get()
+            wait = time.time() - queued
+            try:
+                data = serialize_chunk(storage.execute, p, q, key,
+                    binary=binary)
+            except Exception:
+                traceback.print_exc()
+                data = None
+            model = self.model
+            model.enqueue(model.on_chunk_read, p, q, key, binary, data, wait)
 
 class Model(object):
     def __init__(self, seed):
-        self.world = World(seed)
+        self.world = World(seed, cache_bytes=WORLD_CACHE_BYTES,
+            store=WORLD_STORE_PATH)
         self.clients = []
-        self.queue = Queue.Queue()
+        self.grid = {}
+        self.moved = set()
+        self.block_cache = LRUCache(BLOCK_CACHE_SIZE)
+        self.chunk_cache = LRUCache(CHUNK_CACHE_BYTES)
+        self.uncommitted = set()
+        self.pending = []
+        self.reads = {}
+        self.stale = set()
+        self.reader = None
+        self.authenticator = None
+        # positions are kept per client and chunk requests are served
+        # round robin between clients, nearest first
+        self.scheduler = Scheduler([False, True, True],
+            {TRANSFER: self.rank_chunk})
+        self.queue_stats = [LatencyStats('interactive'),
+            LatencyStats('position'), LatencyStats('chunk')]
+        self.shed = 0
+        self.metrics = Metrics() if METRICS else None
+        self.reader_stats = LatencyStats('chunk')
         self.commands = {
             AUTHENTICATE: self.on_authenticate,
             CHUNK: self.on_chunk,
             BLOCK: self.on_block,
+            BULK: self.on_bulk,
             LIGHT: self.on_light,
             POSITION: self.on_position,
             TALK: self.on_talk,
@@ -184,35 +672,177 @@ class Model(object):
             (re.compile(r'^/pq\s+(-?[0-9]+)\s*,?\s*(-?[0-9]+)$'), self.on_pq),
             (re.compile(r'^/help(?:\s+(\S+))?$'), self.on_help),
             (re.compile(r'^/list$'), self.on_list),
+            (re.compile(r'^/stats$'), self.on_stats),
         ]
     def start(self):
         thread = threading.Thread(target=self.run)
         thread.setDaemon(True)
         thread.start()
     def run(self):
-        self.connection = sqlite3.connect(DB_PATH)
+        self.storage = open_storage()
         self.create_tables()
         self.commit()
+        # block, light and sign rows share one rowid sequence, so the
+        # largest rowid a client has seen is a single key for all three
+        self.last_rowid = max(
+            list(self.execute('select max(rowid) from %s;' % table))[0][0]
+            for table in ('block', 'light', 'sign')) or 0
+        if CHUNK_READERS:
+            self.reader = ChunkReader(self, CHUNK_READERS)
+        self.authenticator = open_authenticator()
+        self.tick()
+        self.last_stats = time.time()
+        interval = 1.0 / TICK_RATE
         while True:
             try:
-                if time.time() - self.last_commit > COMMIT_INTERVAL:
+                now = time.time()
+                if self.storage.commit_due():
                     self.commit()
-                self.dequeue()
+                if now - self.last_tick >= interval:
+                    self.tick()
+                if now - self.last_stats > STATS_INTERVAL:
+                    self.last_stats = now
+                    for stats in self.queue_stats:
+                        stats.flush()
+                    if self.shed:
+                        log('SHED', self.shed)
+                        self.shed = 0
+                    self.reader_stats.flush()
+                    self.log_outboxes()
+                timeout = max(0, self.last_tick + interval - now)
+                if not self.dequeue(timeout) and PREFETCH_RADIUS:
+                    self.prefetch()
             except Exception:
                 traceback.print_exc()
+    def log_outboxes(self):
+        # peak bytes queued for any one client since the last report
+        if not self.clients:
+            return
+        peak = max(self.clients, key=lambda x: x.peak_queued)
+        log('QUEUE', len(self.clients),
+            sum(x.queued for x in self.clients),
+            peak.client_id, peak.peak_queued,
+            sum(x.dropped for x in self.clients))
+        for client in self.clients:
+            client.peak_queued = 0
+            client.dropped = 0
+    def count(self, name, count=1):
+        if self.metrics is not None:
+            self.metrics.incr(name, count)
     def enqueue(self, func, *args, **kwargs):
-        self.queue.put((func, args, kwargs))
-    def dequeue(self):
-        try:
-            func, args, kwargs = self.queue.get(timeout=5)
-            func(*args, **kwargs)
-        except Queue.Empty:
-            pass
+        item = (time.time(), func, args, kwargs)
+        self.scheduler.put(INTERACTIVE, None, None, item)
+    def enqueue_data(self, client, data):
+        # a newer position replaces a pending one and a repeated chunk
+        # request replaces the pending request for the same chunk
+        command = data[0]
+        key = None
+        if command == POSITION:
+            priority, key = MOVEMENT, POSITION
+        elif command == CHUNK:
+            try:
+                p, q = map(int, data.split(',')[1:3])
+                priority, key = TRANSFER, (p, q)
+            except ValueError:
+                priority = INTERACTIVE
+        else:
+            priority = INTERACTIVE
+        item = (time.time(), self.on_data, (client, data), {})
+        self.scheduler.put(priority, client, key, item)
+    def dequeue(self, timeout=5):
+        result = self.scheduler.get(timeout)
+        if result is None:
+            return False
+        priority, (queued, func, args, kwargs) = result
+        stats = self.queue_stats[priority]
+        stats.add(time.time() - queued)
+        if self.metrics is not None:
+            self.metrics.observe('wait.' + stats.name, time.time() - queued)
+        func(*args, **kwargs)
+        return True
+    def rank_chunk(self, client, key):
+        # distance in chunks from the player, less a bonus for chunks in
+        # the direction the player is facing
+        x, _, z, rx, _ = client.position
+        dp = key[0] + 0.5 - x / CHUNK_SIZE
+        dq = key[1] + 0.5 - z / CHUNK_SIZE
+        ahead = dp * cos(rx - pi / 2) + dq * sin(rx - pi / 2)
+        return hypot(dp, dq) - CHUNK_HEADING_BIAS * ahead
+    def prefetch(self):
+        # while idle, pushes each client the nearest chunk with edits it
+        # has not been sent yet
+        for client in list(self.clients):
+            if len(self.scheduler):
+                return
+            if client.chunk is None or client.version is None:
+                continue
+            p, q = client.chunk
+            radius = PREFETCH_RADIUS
+            chunks = [(p + dp, q + dq)
+                for dp in range(-radius, radius + 1)
+                for dq in range(-radius, radius + 1)
+                if (p + dp, q + dq) not in client.sent]
+            chunks.sort(key=lambda x: self.rank_chunk(client, x))
+            for key in chunks:
+                client.sent.add(key)
+                if self.get_blocks(*key):
+                    self.on_chunk(client, key[0], key[1])
+                    break
+    def tick(self):
+        self.last_tick = time.time()
+        self.flush()
+        if self.moved:
+            moved = self.moved
+            self.moved = set()
+            self.broadcast_positions(moved)
     def execute(self, *args, **kwargs):
-        return self.connection.execute(*args, **kwargs)
+        self.flush()
+        if self.metrics is None:
+            return self.storage.execute(*args, **kwargs)
+        start = time.time()
+        result = self.storage.execute(*args, **kwargs)
+        self.metrics.observe('sqlite.execute', time.time() - start)
+        return result
+    def write(self, query, args):
+        # buffered until the next read or commit, then flushed in order
+        # with one executemany per run of identical statements
+        pending = self.pending
+        if pending and pending[-1][0] == query:
+            pending[-1][1].append(args)
+        else:
+            pending.append((query, [args]))
+    def flush(self):
+        if self.pending:
+            pending = self.pending
+            self.pending = []
+            start = time.time()
+            for query, rows in pending:
+                try:
+                    self.storage.executemany(query, rows)
+                except Exception:
+                    # nothing was applied, so retry row by row and only
+                    # lose the bad rows
+                    for row in rows:
+                        try:
+                            self.storage.execute(query, row)
+                        except Exception:
+                            log('DROP', query, row)
+                            traceback.print_exc()
+            if self.metrics is not None:
+                self.metrics.observe('sqlite.flush', time.time() - start)
     def commit(self):
-        self.last_commit = time.time()
-        self.connection.commit()
+        self.flush()
+        start = time.time()
+        self.storage.commit()
+        if self.metrics is not None:
+            self.metrics.observe('sqlite.commit', time.time() - start)
+        self.uncommitted.clear()
+    def invalidate_chunk(self, p, q):
+        self.chunk_cache.pop((p, q))
+        self.uncommitted.add((p, q))
+        for read in self.reads:
+            if read[0] == p and read[1] == q:
+                self.stale.add(read)
     def create_tables(self):
         queries = [
             'create table if not exists block ('
@@ -225,6 +855,7 @@ class Model(object):
             ');',
             'create unique index if not exists block_pqxyz_idx on '
             '    block (p, q, x, y, z);',
+            'create index if not exists block_pq_idx on block (p, q);',
             'create table if not exists light ('
             '    p int not null,'
             '    q int not null,'
@@ -235,6 +866,7 @@ class Model(object):
             ');',
             'create unique index if not exists light_pqxyz_idx on '
             '    light (p, q, x, y, z);',
+            'create index if not exists light_pq_idx on light (p, q);',
             'create table if not exists sign ('
             '    p int not null,'
             '    q int not null,'
@@ -261,17 +893,43 @@ class Model(object):
     def get_default_block(self, x, y, z):
         p, q = chunked(x), chunked(z)
         chunk = self.world.get_chunk(p, q)
-        return chunk.get((x, y, z), 0)
+        return chunk.get(x, y, z)
+    def next_rowid(self):
+        self.last_rowid += 1
+        return self.last_rowid
+    def get_blocks(self, p, q):
+        # all block rows of a chunk as {(x, y, z): (rowid, w)}, cached
+        # write-through so the hot path never queries sqlite twice
+        blocks = self.block_cache.get((p, q))
+        if blocks is None:
+            query = (
+                'select rowid, x, y, z, w from block where '
+                'p = ? and q = ?;'
+            )
+            rows = self.execute(query, (p, q))
+            blocks = dict(((x, y, z), (rowid, w))
+                for rowid, x, y, z, w in rows)
+            self.block_cache.set((p, q), blocks, len(blocks) + 1)
+        return blocks
     def get_block(self, x, y, z):
-        query = (
-            'select w from block where '
-            'p = :p and q = :q and x = :x and y = :y and z = :z;'
-        )
         p, q = chunked(x), chunked(z)
-        rows = list(self.execute(query, dict(p=p, q=q, x=x, y=y, z=z)))
-        if rows:
-            return rows[0][0]
+        blocks = self.get_blocks(p, q)
+        if (x, y, z) in blocks:
+            return blocks[(x, y, z)][1]
         return self.get_default_block(x, y, z)
+    def set_block(self, p, q, x, y, z, w):
+        # rowids are assigned here so that buffered writes still get
+        # strictly increasing cache keys
+        query = (
+            'insert or replace into block (rowid, p, q, x, y, z, w) '
+            'values (?, ?, ?, ?, ?, ?, ?);'
+        )
+        self.write(query, (self.next_rowid(), p, q, x, y, z, w))
+        self.invalidate_chunk(p, q)
+        blocks = self.block_cache.get((p, q))
+        if blocks is not None:
+            blocks[(x, y, z)] = (self.last_rowid, w)
+            self.block_cache.set((p, q), blocks, len(blocks) + 1)
     def next_client_id(self):
         result = 1
         client_ids = set(x.client_id for x in self.clients)
@@ -282,7 +940,10 @@ class Model(object):
         client.client_id = self.next_client_id()
         client.nick = 'guest%d' % client.client_id
         log('CONN', client.client_id, *client.client_address)
+        self.count('connects')
         client.position = SPAWN_POINT
+        client.chunk = None
+        client.sent = set()
         self.clients.append(client)
         client.send(YOU, client.client_id, *client.position)
         client.send(TIME, time.time(), DAY_LENGTH)
@@ -296,35 +957,61 @@ class Model(object):
         #log('RECV', client.client_id, data)
         args = data.split(',')
         command, args = args[0], args[1:]
+        if client.held is not None and command not in (POSITION, CHUNK):
+            # replayed once the pending login completes
+            client.held.append(data)
+            return
         if command in self.commands:
             func = self.commands[command]
-            func(client, *args)
+            if self.metrics is None:
+                func(client, *args)
+            else:
+                start = time.time()
+                func(client, *args)
+                self.metrics.observe('command.' + command, time.time() - start)
     def on_disconnect(self, client):
         log('DISC', client.client_id, *client.client_address)
+        self.count('disconnects')
+        self.scheduler.discard(client)
         self.clients.remove(client)
+        self.moved.discard(client)
+        self.remove_chunk(client)
         self.send_disconnect(client)
         self.send_talk('%s has disconnected from the server.' % client.nick)
     def on_version(self, client, version):
-        if client.version is not None:
-            return
+        # clients send V,1 and may follow it with the highest version they
+        # support, which older servers ignore; the accepted version is
+        # sent back and the client parses frames and compressed batches
+        # only after seeing it
         version = int(version)
-        if version != 1:
+        if version < 1:
             client.stop()
             return
+        version = min(version, PROTOCOL_VERSION)
+        if client.version is not None and version <= client.version:
+            return
         client.version = version
+        client.binary = version >= BINARY_VERSION
+        client.send(VERSION, version)
+        if version >= COMPRESS_VERSION and COMPRESSION_LEVEL:
+            client.start_compression(COMPRESSION_LEVEL)
         # TODO: client.start() here
     def on_authenticate(self, client, username, access_token):
-        user_id = None
-        if username and access_token:
-            url = 'https://craft.michaelfogleman.com/api/1/access'
-            payload = {
-                'username': username,
-                'access_token': access_token,
-            }
-            response = requests.post(url, data=payload)
-            if response.status_code == 200 and response.text.isdigit():
-                user_id = int(response.text)
+        if not username or not access_token:
+            self.on_authenticated(client, username, None)
+            return
+        # later commands may need the user id, so they are held until the
+        # login completes
+        if client.held is None:
+            client.held = []
+        def callback(user_id):
+            self.enqueue(self.on_authenticated, client, username, user_id)
+        self.authenticator.authenticate(username, access_token, callback)
+    def on_authenticated(self, client, username, user_id):
+        if client not in self.clients:
+            return
         client.user_id = user_id
+        self.count('auth.guest' if user_id is None else 'auth.user')
         if user_id is None:
             client.nick = 'guest%d' % client.client_id
             client.send(TALK, 'Visit craft.michaelfogleman.com to register!')
@@ -333,79 +1020,113 @@ class Model(object):
         self.send_nick(client)
         # TODO: has left message if was already authenticated
         self.send_talk('%s has joined the game.' % client.nick)
+        held, client.held = client.held, None
+        for data in held or ():
+            self.on_data(client, data)
     def on_chunk(self, client, p, q, key=0):
-        packets = []
         p, q, key = map(int, (p, q, key))
-        query = (
-            'select rowid, x, y, z, w from block where '
-            'p = :p and q = :q and rowid > :key;'
-        )
-        rows = self.execute(query, dict(p=p, q=q, key=key))
-        max_rowid = 0
-        blocks = 0
-        for rowid, x, y, z, w in rows:
-            blocks += 1
-            packets.append(packet(BLOCK, p, q, x, y, z, w))
-            max_rowid = max(max_rowid, rowid)
-        query = (
-            'select x, y, z, w from light where '
-            'p = :p and q = :q;'
-        )
-        rows = self.execute(query, dict(p=p, q=q))
-        lights = 0
-        for x, y, z, w in rows:
-            lights += 1
-            packets.append(packet(LIGHT, p, q, x, y, z, w))
-        query = (
-            'select x, y, z, face, text from sign where '
-            'p = :p and q = :q;'
-        )
-        rows = self.execute(query, dict(p=p, q=q))
-        signs = 0
-        for x, y, z, face, text in rows:
-            signs += 1
-            packets.append(packet(SIGN, p, q, x, y, z, face, text))
-        if blocks:
-            packets.append(packet(KEY, p, q, max_rowid))
-        if blocks or lights or signs:
-            packets.append(packet(REDRAW, p, q))
-        packets.append(packet(CHUNK, p, q))
-        client.send_raw(''.join(packets))
+        if client.chunk is not None:
+            cp, cq = client.chunk
+            if max(abs(p - cp), abs(q - cq)) > VIEW_RADIUS:
+                # requested before a teleport, no longer visible
+                self.shed += 1
+                self.count('shed')
+                return
+        client.sent.add((p, q))
+        binary = client.binary
+        # serialized responses by key and format; dropped whenever the
+        # chunk changes
+        payloads = self.chunk_cache.get((p, q))
+        data = payloads and payloads.get((key, binary))
+        if data is not None:
+            client.send_raw(data)
+        elif (p, q, key, binary) in self.reads:
+            self.reads[(p, q, key, binary)].append(client)
+        elif self.reader is None or (p, q) in self.uncommitted:
+            # readers only see committed rows, so serve these inline
+            data = self.serialize_chunk(p, q, key, binary)
+            self.cache_chunk(p, q, key, binary, data)
+            client.send_raw(data)
+        else:
+            self.reads[(p, q, key, binary)] = [client]
+            self.reader.read(p, q, key, binary)
+    def on_chunk_read(self, p, q, key, binary, data, wait):
+        self.reader_stats.add(wait)
+        if self.metrics is not None:
+            self.metrics.observe('wait.reader', wait)
+        clients = self.reads.pop((p, q, key, binary))
+        if (p, q, key, binary) in self.stale or data is None:
+            self.stale.discard((p, q, key, binary))
+            data = self.serialize_chunk(p, q, key, binary)
+        self.cache_chunk(p, q, key, binary, data)
+        for client in clients:
+            client.send_raw(data)
+    def cache_chunk(self, p, q, key, binary, data):
+        payloads = self.chunk_cache.get((p, q)) or {}
+        payloads[(key, binary)] = data
+        size = sum(len(x) for x in payloads.itervalues())
+        self.chunk_cache.set((p, q), payloads, size)
+    def serialize_chunk(self, p, q, key, binary):
+        blocks = [(rowid, x, y, z, w)
+            for (x, y, z), (rowid, w) in self.get_blocks(p, q).iteritems()
+            if rowid > key]
+        return serialize_chunk(self.execute, p, q, key, blocks, binary)
     def on_block(self, client, x, y, z, w):
         x, y, z, w = map(int, (x, y, z, w))
         p, q = chunked(x), chunked(z)
         previous = self.get_block(x, y, z)
-        message = None
+        message = self.check_block(client, x, y, z, w, previous)
+        if message is not None:
+            client.send(BLOCK, p, q, x, y, z, previous)
+            client.send(REDRAW, p, q)
+            client.send(TALK, message)
+            return
+        self.send_blocks(client, self.apply_block(client, x, y, z, w))
+    def on_bulk(self, client, w, *args):
+        # M,w,x,y,z,x,y,z,... sets every listed block to item w
+        if len(args) > 3 * BULK_SIZE:
+            client.send(TALK, 'At most %d blocks can be changed at once.'
+                % BULK_SIZE)
+            return
+        w = int(w)
+        coords = map(int, args)
+        blocks = []
+        rejected = 0
+        for i in range(0, len(coords) - 2, 3):
+            x, y, z = coords[i:i + 3]
+            previous = self.get_block(x, y, z)
+            if self.check_block(client, x, y, z, w, previous) is not None:
+                rejected += 1
+                continue
+            blocks.extend(self.apply_block(client, x, y, z, w))
+        self.send_blocks(client, blocks)
+        if rejected:
+            client.send(TALK, '%d blocks could not be changed.' % rejected)
+    def check_block(self, client, x, y, z, w, previous):
         if client.user_id is None:
-            message = 'Only logged in users are allowed to build.'
+            return 'Only logged in users are allowed to build.'
         elif y <= 0 or y > 255:
-            message = 'Invalid block coordinates.'
+            return 'Invalid block coordinates.'
         elif w not in ALLOWED_ITEMS:
-            message = 'That item is not allowed.'
+            return 'That item is not allowed.'
         elif w and previous:
-            message = 'Cannot create blocks in a non-empty space.'
+            return 'Cannot create blocks in a non-empty space.'
         elif not w and not previous:
-            message = 'That space is already empty.'
+            return 'That space is already empty.'
         elif previous in INDESTRUCTIBLE_ITEMS:
-            message = 'Cannot destroy that type of block.'
-        if message is not None:
-            client.send(BLOCK, p, q, x, y, z, previous)
-            client.send(REDRAW, p, q)
-            client.send(TALK, message)
-            return
+            return 'Cannot destroy that type of block.'
+        return None
+    def apply_block(self, client, x, y, z, w):
+        # returns the changed rows, including neighbor shadow rows
+        p, q = chunked(x), chunked(z)
         query = (
             'insert into block_history (timestamp, user_id, x, y, z, w) '
-            'values (:timestamp, :user_id, :x, :y, :z, :w);'
+            'values (?, ?, ?, ?, ?, ?);'
         )
         if RECORD_HISTORY:
-            self.execute(query, dict(timestamp=time.time(),
-                user_id=client.user_id, x=x, y=y, z=z, w=w))
-        query = (
-            'insert or replace into block (p, q, x, y, z, w) '
-            'values (:p, :q, :x, :y, :z, :w);'
-        )
-        self.execute(query, dict(p=p, q=q, x=x, y=y, z=z, w=w))
-        self.send_block(client, p, q, x, y, z, w)
+            self.write(query, (time.time(), client.user_id, x, y, z, w))
+        self.set_block(p, q, x, y, z, w)
+        blocks = [(p, q, x, y, z, w)]
         for dx in range(-1, 2):
             for dz in range(-1, 2):
                 if dx == 0 and dz == 0:
@@ -415,19 +1136,20 @@ class Model(object):
                 if dz and chunked(z + dz) == q:
                     continue
                 np, nq = p + dx, q + dz
-                self.execute(query, dict(p=np, q=nq, x=x, y=y, z=z, w=-w))
-                self.send_block(client, np, nq, x, y, z, -w)
+                self.set_block(np, nq, x, y, z, -w)
+                blocks.append((np, nq, x, y, z, -w))
         if w == 0:
             query = (
                 'delete from sign where '
-                'x = :x and y = :y and z = :z;'
+                'x = ? and y = ? and z = ?;'
             )
-            self.execute(query, dict(x=x, y=y, z=z))
+            self.write(query, (x, y, z))
             query = (
                 'update light set w = 0 where '
-                'x = :x and y = :y and z = :z;'
+                'x = ? and y = ? and z = ?;'
             )
-            self.execute(query, dict(x=x, y=y, z=z))
+            self.write(query, (x, y, z))
+        return blocks
     def on_light(self, client, x, y, z, w):
         x, y, z, w = map(int, (x, y, z, w))
         p, q = chunked(x), chunked(z)
@@ -445,10 +1167,11 @@ class Model(object):
             client.send(TALK, message)
             return
         query = (
-            'insert or replace into light (p, q, x, y, z, w) '
-            'values (:p, :q, :x, :y, :z, :w);'
+            'insert or replace into light (rowid, p, q, x, y, z, w) '
+            'values (?, ?, ?, ?, ?, ?, ?);'
         )
-        self.execute(query, dict(p=p, q=q, x=x, y=y, z=z, w=w))
+        self.write(query, (self.next_rowid(), p, q, x, y, z, w))
+        self.invalidate_chunk(p, q)
         self.send_light(client, p, q, x, y, z, w)
     def on_sign(self, client, x, y, z, face, *args):
         if client.user_id is None:
@@ -460,27 +1183,26 @@ class Model(object):
             return
         if face < 0 or face > 7:
             return
-        if len(text) > 48:
+        try:
+            value = text.decode('utf-8')
+        except UnicodeDecodeError:
+            return
+        if len(value) > 48:
             return
         p, q = chunked(x), chunked(z)
-        if text:
-            query = (
-                'insert or replace into sign (p, q, x, y, z, face, text) '
-                'values (:p, :q, :x, :y, :z, :face, :text);'
-            )
-            self.execute(query,
-                dict(p=p, q=q, x=x, y=y, z=z, face=face, text=text))
-        else:
-            query = (
-                'delete from sign where '
-                'x = :x and y = :y and z = :z and face = :face;'
-            )
-            self.execute(query, dict(x=x, y=y, z=z, face=face))
+        # removed signs are kept with empty text so that clients syncing
+        # from an older key still hear about the removal
+        query = (
+            'insert or replace into sign (rowid, p, q, x, y, z, face, text) '
+            'values (?, ?, ?, ?, ?, ?, ?, ?);'
+        )
+        self.write(query, (self.next_rowid(), p, q, x, y, z, face, value))
+        self.invalidate_chunk(p, q)
         self.send_sign(client, p, q, x, y, z, face, text)
     def on_position(self, client, x, y, z, rx, ry):
         x, y, z, rx, ry = map(float, (x, y, z, rx, ry))
         client.position = (x, y, z, rx, ry)
-        self.send_position(client)
+        self.moved.add(client)
     def on_talk(self, client, *args):
         text = ','.join(args)
         if text.startswith('/'):
@@ -502,10 +1224,20 @@ class Model(object):
                 client.send(TALK, 'Unrecognized nick: "%s"' % nick)
         else:
             self.send_talk('%s> %s' % (client.nick, text))
-    def on_spawn(self, client):
-        client.position = SPAWN_POINT
+    def teleport(self, client, position):
+        # pending positions are for the old location, and so are chunk
+        # requests out of view of the new one
+        p, q = chunked(position[0]), chunked(position[2])
+        shed = self.scheduler.discard(client, (MOVEMENT,))
+        shed += self.scheduler.discard(client, (TRANSFER,),
+            lambda x: max(abs(x[0] - p), abs(x[1] - q)) > VIEW_RADIUS)
+        self.shed += shed
+        self.count('shed', shed)
+        client.position = position
         client.send(YOU, client.client_id, *client.position)
         self.send_position(client)
+    def on_spawn(self, client):
+        self.teleport(client, SPAWN_POINT)
     def on_goto(self, client, nick=None):
         if nick is None:
             clients = [x for x in self.clients if x != client]
@@ -514,16 +1246,12 @@ class Model(object):
             nicks = dict((client.nick, client) for client in self.clients)
             other = nicks.get(nick)
         if other:
-            client.position = other.position
-            client.send(YOU, client.client_id, *client.position)
-            self.send_position(client)
+            self.teleport(client, other.position)
     def on_pq(self, client, p, q):
         p, q = map(int, (p, q))
         if abs(p) > 1000 or abs(q) > 1000:
             return
-        client.position = (p * CHUNK_SIZE, 0, q * CHUNK_SIZE, 0, 0)
-        client.send(YOU, client.client_id, *client.position)
-        self.send_position(client)
+        self.teleport(client, (p * CHUNK_SIZE, 0, q * CHUNK_SIZE, 0, 0))
     def on_help(self, client, topic=None):
         if topic is None:
             client.send(TALK, 'Type "t" to chat. Type "/" to type commands:')
@@ -565,83 +1293,268 @@ class Model(object):
     def on_list(self, client):
         client.send(TALK,
             'Players: %s' % ', '.join(x.nick for x in self.clients))
-    def send_positions(self, client):
-        for other in self.clients:
-            if other == client:
-                continue
+    def on_stats(self, client):
+        if client.user_id not in ADMIN_USER_IDS:
+            client.send(TALK, 'Only admins can view server stats.')
+            return
+        for line in self.stats():
+            client.send(TALK, line)
+    def stats(self):
+        # plain text report lines; may be called from any thread
+        clients = list(self.clients)
+        sizes = self.scheduler.sizes()
+        gauges = [('clients', len(clients))]
+        for stats, size in zip(self.queue_stats, sizes):
+            gauges.append(('queue.' + stats.name, size))
+        gauges.extend([
+            ('outbox.bytes', sum(x.queued for x in clients)),
+            ('bytes.in', sum(x.bytes_in for x in clients)),
+            ('bytes.out', sum(x.bytes_out for x in clients)),
+            ('cache.blocks', self.block_cache.size),
+            ('cache.chunks', self.chunk_cache.size),
+        ])
+        if self.metrics is None:
+            lines = ['%s %s' % x for x in gauges]
+        else:
+            lines = self.metrics.report(gauges)
+        clients.sort(key=lambda x: x.bytes_out, reverse=True)
+        for client in clients[:STATS_CLIENTS]:
+            lines.append('client.%s in=%d out=%d queued=%d' % (
+                client.client_id, client.bytes_in, client.bytes_out,
+                client.queued))
+        return lines
+    def nearby_clients(self, p, q, radius):
+        if (radius * 2 + 1) ** 2 < len(self.grid):
+            for dp in range(-radius, radius + 1):
+                for dq in range(-radius, radius + 1):
+                    for other in self.grid.get((p + dp, q + dq), ()):
+                        yield other
+        else:
+            for (cp, cq), members in self.grid.iteritems():
+                if abs(cp - p) <= radius and abs(cq - q) <= radius:
+                    for other in members:
+                        yield other
+    def remove_chunk(self, client):
+        members = self.grid.get(client.chunk)
+        if members is not None:
+            members.discard(client)
+            if not members:
+                del self.grid[client.chunk]
+    def update_chunk(self, client):
+        # moves client in the grid and returns the players that just came
+        # into its view; players that left the view are told both ways
+        x, y, z, rx, ry = client.position
+        chunk = (chunked(x), chunked(z))
+        previous = client.chunk
+        if chunk == previous:
+            return set()
+        self.remove_chunk(client)
+        self.grid.setdefault(chunk, set()).add(client)
+        client.chunk = chunk
+        if previous is None:
+            return set()
+        radius = PLAYER_VIEW_RADIUS
+        before = set(self.nearby_clients(previous[0], previous[1], radius))
+        after = set(self.nearby_clients(chunk[0], chunk[1], radius))
+        before.discard(client)
+        after.discard(client)
+        for other in before - after:
+            other.send(DISCONNECT, client.client_id)
+            client.send(DISCONNECT, other.client_id)
+        entered = after - before
+        for other in entered:
             client.send(POSITION, other.client_id, *other.position)
+            client.send(NICK, other.client_id, other.nick)
+        return entered
+    def broadcast(self, clients, data, exclude=None):
+        # data is serialized once and the same string is queued for every
+        # recipient
+        for client in clients:
+            if client != exclude:
+                client.send_raw(data)
+    def send_positions(self, client):
+        p, q = client.chunk
+        client.send_raw(''.join(
+            packet(POSITION, other.client_id, *other.position)
+            for other in self.nearby_clients(p, q, PLAYER_VIEW_RADIUS)
+            if other != client))
     def send_position(self, client):
-        for other in self.clients:
-            if other == client:
-                continue
-            other.send(POSITION, client.client_id, *client.position)
+        self.moved.discard(client)
+        self.broadcast_positions([client])
+    def broadcast_positions(self, clients):
+        # one joined buffer per recipient with every position it can see
+        batches = {}
+        for client in clients:
+            entered = self.update_chunk(client)
+            data = packet(POSITION, client.client_id, *client.position)
+            p, q = client.chunk
+            for other in self.nearby_clients(p, q, PLAYER_VIEW_RADIUS):
+                if other == client:
+                    continue
+                batch = batches.setdefault(other, [])
+                batch.append(data)
+                if other in entered:
+                    batch.append(packet(NICK, client.client_id, client.nick))
+        for other, batch in batches.iteritems():
+            other.send_raw(''.join(batch))
     def send_nicks(self, client):
-        for other in self.clients:
-            if other == client:
-                continue
-            client.send(NICK, other.client_id, other.nick)
+        p, q = client.chunk
+        client.send_raw(''.join(
+            packet(NICK, other.client_id, other.nick)
+            for other in self.nearby_clients(p, q, PLAYER_VIEW_RADIUS)
+            if other != client))
     def send_nick(self, client):
-        for other in self.clients:
-            other.send(NICK, client.client_id, client.nick)
+        data = packet(NICK, client.client_id, client.nick)
+        self.broadcast(self.clients, data)
     def send_disconnect(self, client):
-        for other in self.clients:
-            if other == client:
-                continue
-            other.send(DISCONNECT, client.client_id)
-    def send_block(self, client, p, q, x, y, z, w):
-        for other in self.clients:
-            if other == client:
-                continue
-            other.send(BLOCK, p, q, x, y, z, w)
-            other.send(REDRAW, p, q)
+        data = packet(DISCONNECT, client.client_id)
+        self.broadcast(self.clients, data, client)
+    def send_blocks(self, client, blocks):
+        # per recipient, one buffer with each chunk's blocks and one REDRAW
+        chunks = {}
+        for p, q, x, y, z, w in blocks:
+            packets = chunks.setdefault((p, q), [])
+            packets.append(packet(BLOCK, p, q, x, y, z, w))
+        batches = {}
+        for (p, q), packets in chunks.iteritems():
+            packets.append(packet(REDRAW, p, q))
+            data = ''.join(packets)
+            for other in self.nearby_clients(p, q, VIEW_RADIUS):
+                if other == client:
+                    continue
+                batches.setdefault(other, []).append(data)
+        for other, batch in batches.iteritems():
+            other.send_raw(''.join(batch))
     def send_light(self, client, p, q, x, y, z, w):
-        for other in self.clients:
-            if other == client:
-                continue
-            other.send(LIGHT, p, q, x, y, z, w)
-            other.send(REDRAW, p, q)
+        data = packet(LIGHT, p, q, x, y, z, w) + packet(REDRAW, p, q)
+        self.broadcast(self.nearby_clients(p, q, VIEW_RADIUS), data, client)
     def send_sign(self, client, p, q, x, y, z, face, text):
-        for other in self.clients:
-            if other == client:
-                continue
-            other.send(SIGN, p, q, x, y, z, face, text)
+        data = packet(SIGN, p, q, x, y, z, face, text)
+        self.broadcast(self.nearby_clients(p, q, VIEW_RADIUS), data, client)
     def send_talk(self, text):
         log(text)
-        for client in self.clients:
-            client.send(TALK, text)
+        self.broadcast(self.clients, packet(TALK, text))
 
-def cleanup():
+class StatsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        data = '\n'.join(self.server.model.stats()) + '\n'
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+    def log_message(self, *args):
+        pass
+
+def serve_stats(model):
+    server = BaseHTTPServer.HTTPServer((STATS_HOST, STATS_PORT), StatsHandler)
+    server.model = model
+    thread = threading.Thread(target=server.serve_forever)
+    thread.setDaemon(True)
+    thread.start()
+
+def cleanup_redundant(chunk, rows, last):
+    # rows are (rowid, x, y, z, w); a row is redundant when it matches the
+    # generated terrain, shadow rows and generated padding both hold the
+    # neighbor's block negated so they compare directly
+    for rowid, x, y, z, w in rows:
+        if rowid == last:
+            continue
+        original = chunk.get(x, y, z)
+        if w == original or abs(original) in INDESTRUCTIBLE_ITEMS:
+            yield rowid
+
+def cleanup(dry_run=False, restart=False):
+    # streams chunks in (p, q) order, deleting blocks that match the
+    # generated terrain in batched transactions; progress is committed
+    # with each batch so an interrupted run resumes where it stopped
     world = World(None)
-    conn = sqlite3.connect(DB_PATH)
-    query = 'select x, y, z from block order by rowid desc limit 1;'
-    last = list(conn.execute(query))[0]
-    query = 'select distinct p, q from block;'
-    chunks = list(conn.execute(query))
-    count = 0
-    total = 0
-    delete_query = 'delete from block where x = %d and y = %d and z = %d;'
-    print 'begin;'
-    for p, q in chunks:
-        chunk = world.create_chunk(p, q)
-        query = 'select x, y, z, w from block where p = :p and q = :q;'
-        rows = conn.execute(query, {'p': p, 'q': q})
-        for x, y, z, w in rows:
-            if chunked(x) != p or chunked(z) != q:
-                continue
-            total += 1
-            if (x, y, z) == last:
-                continue
-            original = chunk.get((x, y, z), 0)
-            if w == original or original in INDESTRUCTIBLE_ITEMS:
-                count += 1
-                print delete_query % (x, y, z)
-    conn.close()
-    print 'commit;'
-    print >> sys.stderr, '%d of %d blocks will be cleaned up' % (count, total)
+    storage = open_storage(readonly=dry_run)
+    execute = storage.execute
+    last = list(execute('select max(rowid) from block;'))[0][0]
+    total_chunks = list(execute('select count(*) from ('
+        'select distinct p, q from block);'))[0][0]
+    p, q = None, None
+    if not dry_run:
+        execute('create table if not exists cleanup_progress ('
+            '    p int not null,'
+            '    q int not null'
+            ');')
+        if restart:
+            execute('delete from cleanup_progress;')
+        rows = list(execute('select p, q from cleanup_progress;'))
+        if rows:
+            p, q = rows[0]
+            log('CLEANUP', 'resuming after', p, q)
+    chunks = blocks = deleted = 0
+    start = last_report = time.time()
+    while True:
+        if p is None:
+            query = 'select distinct p, q from block order by p, q limit ?;'
+            args = (CLEANUP_BATCH_SIZE,)
+        else:
+            query = (
+                'select distinct p, q from block '
+                'where p > ? or (p = ? and q > ?) '
+                'order by p, q limit ?;'
+            )
+            args = (p, p, q, CLEANUP_BATCH_SIZE)
+        batch = list(execute(query, args))
+        if not batch:
+            break
+        redundant = []
+        for chunk in world.generate_many(batch):
+            query = 'select rowid, x, y, z, w from block where p = ? and q = ?;'
+            rows = list(execute(query, (chunk.p, chunk.q)))
+            blocks += len(rows)
+            redundant.extend(cleanup_redundant(chunk, rows, last))
+        chunks += len(batch)
+        deleted += len(redundant)
+        p, q = batch[-1]
+        if not dry_run:
+            storage.executemany('delete from block where rowid = ?;',
+                ((rowid,) for rowid in redundant))
+            execute('delete from cleanup_progress;')
+            execute('insert into cleanup_progress (p, q) values (?, ?);',
+                (p, q))
+            storage.commit()
+        now = time.time()
+        if now - last_report >= CLEANUP_REPORT_INTERVAL:
+            last_report = now
+            log('CLEANUP', '%d/%d chunks, %d/%d blocks, %.1f chunks/s' % (
+                chunks, total_chunks, deleted, blocks, chunks / (now - start)))
+    if not dry_run:
+        execute('drop table cleanup_progress;')
+        storage.commit()
+    storage.close()
+    elapsed = time.time() - start
+    log('CLEANUP', '%d of %d blocks %s in %d chunks, %.1f seconds' % (
+        deleted, blocks, 'are redundant' if dry_run else 'deleted',
+        chunks, elapsed))
+
+def prewarm(radius=PREWARM_RADIUS):
+    if WORLD_STORE_PATH is None:
+        print >> sys.stderr, 'WORLD_STORE_PATH is not configured'
+        return
+    world = World(None, store=WORLD_STORE_PATH)
+    radius = int(radius)
+    p, q = chunked(SPAWN_POINT[0]), chunked(SPAWN_POINT[2])
+    chunks = [(p + dp, q + dq)
+        for dp in range(-radius, radius + 1)
+        for dq in range(-radius, radius + 1)]
+    start = time.time()
+    count = world.prewarm(chunks)
+    elapsed = time.time() - start
+    print >> sys.stderr, '%d of %d chunks generated in %.1f seconds' % (
+        count, len(chunks), elapsed)
 
 def main():
-    if len(sys.argv) == 2 and sys.argv[1] == 'cleanup':
-        cleanup()
+    if len(sys.argv) > 1 and sys.argv[1] == 'cleanup':
+        options = set(sys.argv[2:])
+        cleanup('--dry-run' in options, '--restart' in options)
+        return
+    if len(sys.argv) in (2, 3) and sys.argv[1] == 'prewarm':
+        prewarm(*sys.argv[2:])
         return
     host, port = DEFAULT_HOST, DEFAULT_PORT
     if len(sys.argv) > 1:
@@ -651,7 +1564,12 @@ def main():
     log('SERV', host, port)
     model = Model(None)
     model.start()
-    server = Server((host, port), Handler)
+    if STATS_PORT:
+        serve_stats(model)
+    if EVENT_LOOP:
+        server = EventServer((host, port))
+    else:
+        server = Server((host, port), Handler)
     server.model = model
     server.serve_forever()
 
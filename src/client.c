@@ -11,8 +11,10 @@
 #include <stdio.h>
 #include <stdlib.h>
 #include <string.h>
+#include <zlib.h>
 #include "client.h"
 #include "tinycthread.h"
+#include "util.h"
 
 #define QUEUE_SIZE 1048576
 #define RECV_SIZE 4096
@@ -26,6 +28,7 @@ static char *queue = 0;
 static int qsize = 0;
 static thrd_t recv_thread;
 static mtx_t mutex;
+static z_stream stream;
 
 void client_enable() {
     client_enabled = 1;
@@ -176,6 +179,48 @@ char *client_recv() {
     return result;
 }
 
+char *client_inflate(const char *text) {
+    // decodes the next segment of the server's deflate stream from the
+    // base64 text of a Z line, returning the lines it contains
+    int length = strlen(text) / 4 * 3 + 3;
+    unsigned char *data = malloc(length);
+    length = base64_decode(text, data, length);
+    if (length < 0) {
+        free(data);
+        return 0;
+    }
+    int size = length * 8 + 1024;
+    char *result = malloc(size);
+    stream.next_in = data;
+    stream.avail_in = length;
+    int count = 0;
+    while (1) {
+        stream.next_out = (unsigned char *)result + count;
+        stream.avail_out = size - count - 1;
+        int status = inflate(&stream, Z_SYNC_FLUSH);
+        count = size - 1 - stream.avail_out;
+        if (status != Z_OK && status != Z_BUF_ERROR) {
+            free(result);
+            result = 0;
+            break;
+        }
+        if (stream.avail_out > 0) {
+            if (stream.avail_in) {
+                free(result);
+                result = 0;
+            }
+            else {
+                result[count] = '\0';
+            }
+            break;
+        }
+        size *= 2;
+        result = realloc(result, size);
+    }
+    free(data);
+    return result;
+}
+
 int recv_worker(void *arg) {
     char *data = malloc(sizeof(char) * RECV_SIZE);
     while (1) {
@@ -241,6 +286,8 @@ void client_start() {
     queue = (char *)calloc(QUEUE_SIZE, sizeof(char));
     qsize = 0;
     mtx_init(&mutex, mtx_plain);
+    memset(&stream, 0, sizeof(stream));
+    inflateInit(&stream);
     if (thrd_create(&recv_thread, recv_worker, NULL) != thrd_success) {
         perror("thrd_create");
         exit(1);
@@ -260,6 +307,7 @@ void client_stop() {
     // mtx_destroy(&mutex);
     qsize = 0;
     free(queue);
+    inflateEnd(&stream);
     // printf("Bytes Sent: %d, Bytes Received: %d\n",
     //     bytes_sent, bytes_received);
 }
@@ -11,6 +11,7 @@ void client_start();
 void client_stop();
 void client_send(char *data);
 char *client_recv();
+char *client_inflate(const char *text);
 void client_version(int version);
 void client_login(const char *username, const char *identity_token);
 void client_position(float x, float y, float z, float rx, float ry);
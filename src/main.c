@@ -6,6 +6,7 @@
 #include <stdlib.h>
 #include <string.h>
 #include <time.h>
+#include <zlib.h>
 #include "auth.h"
 #include "client.h"
 #include "config.h"
@@ -145,6 +146,7 @@ typedef struct {
     char db_path[MAX_PATH_LENGTH];
     char server_addr[MAX_ADDR_LENGTH];
     int server_port;
+    int server_version;
     int day_length;
     int time_changed;
     Block block0;
@@ -2468,6 +2470,81 @@ void handle_movement(double dt) {
     }
 }
 
+int read_int(const unsigned char *data) {
+    return (int)(
+        (unsigned int)data[0] | ((unsigned int)data[1] << 8) |
+        ((unsigned int)data[2] << 16) | ((unsigned int)data[3] << 24));
+}
+
+int read_short(const unsigned char *data) {
+    return data[0] | (data[1] << 8);
+}
+
+void parse_frame(const char *text) {
+    // F,<base64>: p, q, flags and body size, then a body (zlib compressed
+    // if flags & 1) of block, light and sign counts followed by chunk
+    // relative (x + 1, z + 1, y, w) rows and (x + 1, z + 1, y, face,
+    // length, text) signs
+    int length = strlen(text) / 4 * 3 + 3;
+    unsigned char *data = malloc(length);
+    length = base64_decode(text, data, length);
+    if (length < 13) {
+        free(data);
+        return;
+    }
+    int p = read_int(data);
+    int q = read_int(data + 4);
+    int flags = data[8];
+    uLongf size = (unsigned int)read_int(data + 9);
+    unsigned char *body = data + 13;
+    unsigned char *inflated = 0;
+    if (flags & 1) {
+        inflated = malloc(size ? size : 1);
+        if (uncompress(inflated, &size, body, length - 13) != Z_OK) {
+            free(inflated);
+            free(data);
+            return;
+        }
+        body = inflated;
+    }
+    else if (size > (uLongf)(length - 13)) {
+        size = length - 13;
+    }
+    State *s = &g->players->state;
+    int x0 = p * CHUNK_SIZE - 1;
+    int z0 = q * CHUNK_SIZE - 1;
+    unsigned char *end = body + size;
+    unsigned char *b = body + 6;
+    if (b <= end) {
+        int blocks = read_short(body);
+        int lights = read_short(body + 2);
+        int signs = read_short(body + 4);
+        for (int i = 0; i < blocks && b + 4 <= end; i++, b += 4) {
+            int x = x0 + b[0];
+            int z = z0 + b[1];
+            _set_block(p, q, x, b[2], z, (signed char)b[3], 0);
+            if (player_intersects_block(2, s->x, s->y, s->z, x, b[2], z)) {
+                s->y = highest_block(s->x, s->z) + 2;
+            }
+        }
+        for (int i = 0; i < lights && b + 4 <= end; i++, b += 4) {
+            set_light(p, q, x0 + b[0], b[2], z0 + b[1], b[3]);
+        }
+        for (int i = 0; i < signs && b + 5 <= end; i++) {
+            char sign[MAX_SIGN_LENGTH] = {0};
+            int n = b[4];
+            if (b + 5 + n > end) {
+                break;
+            }
+            memcpy(sign, b + 5, MIN(n, MAX_SIGN_LENGTH - 1));
+            _set_sign(p, q, x0 + b[0], b[2], z0 + b[1], b[3], sign, 0);
+            b += 5 + n;
+        }
+    }
+    free(inflated);
+    free(data);
+}
+
 void parse_buffer(char *buffer) {
     Player *me = g->players;
     State *s = &g->players->state;
@@ -2537,6 +2614,20 @@ void parse_buffer(char *buffer) {
             g->day_length = day_length;
             g->time_changed = 1;
         }
+        int version;
+        if (sscanf(line, "V,%d", &version) == 1) {
+            g->server_version = version;
+        }
+        if (g->server_version >= 2 && line[0] == 'F' && line[1] == ',') {
+            parse_frame(line + 2);
+        }
+        if (g->server_version >= 3 && line[0] == 'Z' && line[1] == ',') {
+            char *text = client_inflate(line + 2);
+            if (text) {
+                parse_buffer(text);
+                free(text);
+            }
+        }
         if (line[0] == 'T' && line[1] == ',') {
             char *text = line + 2;
             add_message(text);
@@ -2746,7 +2837,11 @@ int main(int argc, char **argv) {
             client_enable();
             client_connect(g->server_addr, g->server_port);
             client_start();
+            // servers that only know version 1 ignore the second request;
+            // frames and compression are used once the server replies
+            g->server_version = 1;
             client_version(1);
+            client_version(3);
             login();
         }
 
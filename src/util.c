@@ -160,6 +160,44 @@ char *tokenize(char *str, const char *delim, char **key) {
     return result;
 }
 
+int base64_decode(const char *input, unsigned char *output, int size) {
+    // returns the decoded length, or -1 on bad input or overflow
+    unsigned int bits = 0;
+    int count = 0;
+    int length = 0;
+    for (const char *p = input; *p && *p != '='; p++) {
+        int value;
+        if (*p >= 'A' && *p <= 'Z') {
+            value = *p - 'A';
+        }
+        else if (*p >= 'a' && *p <= 'z') {
+            value = *p - 'a' + 26;
+        }
+        else if (*p >= '0' && *p <= '9') {
+            value = *p - '0' + 52;
+        }
+        else if (*p == '+') {
+            value = 62;
+        }
+        else if (*p == '/') {
+            value = 63;
+        }
+        else {
+            return -1;
+        }
+        bits = (bits << 6) | value;
+        count += 6;
+        if (count >= 8) {
+            count -= 8;
+            if (length >= size) {
+                return -1;
+            }
+            output[length++] = (bits >> count) & 0xff;
+        }
+    }
+    return length;
+}
+
 int char_width(char input) {
     static const int lookup[128] = {
         0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0,
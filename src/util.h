@@ -39,6 +39,7 @@ GLuint make_program(GLuint shader1, GLuint shader2);
 GLuint load_program(const char *path1, const char *path2);
 void load_png_texture(const char *file_name);
 char *tokenize(char *str, const char *delim, char **key);
+int base64_decode(const char *input, unsigned char *output, int size);
 int char_width(char input);
 int string_width(const char *input);
 int wrap(const char *input, int max_width, char *output, int max_length);
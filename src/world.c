@@ -1,8 +1,17 @@
+#include <string.h>
 #include "config.h"
 #include "noise.h"
 #include "world.h"
 
-void create_world(int p, int q, world_func func, void *arg) {
+typedef struct {
+    int x;
+    int z;
+    signed char *data;
+} WorldVolume;
+
+void create_world_state(
+    const unsigned char *perm, int p, int q, world_func func, void *arg)
+{
     int pad = 1;
     for (int dx = -pad; dx < CHUNK_SIZE + pad; dx++) {
         for (int dz = -pad; dz < CHUNK_SIZE + pad; dz++) {
@@ -12,8 +21,9 @@ void create_world(int p, int q, world_func func, void *arg) {
             }
             int x = p * CHUNK_SIZE + dx;
             int z = q * CHUNK_SIZE + dz;
-            float f = simplex2(x * 0.01, z * 0.01, 4, 0.5, 2);
-            float g = simplex2(-x * 0.01, -z * 0.01, 2, 0.9, 2);
+            float f = simplex2_state(perm, x * 0.01, z * 0.01, 4, 0.5, 2);
+            float g = simplex2_state(
+                perm, -x * 0.01, -z * 0.01, 2, 0.9, 2);
             int mh = g * 32 + 16;
             int h = f * mh;
             int w = 1;
@@ -29,12 +39,17 @@ void create_world(int p, int q, world_func func, void *arg) {
             if (w == 1) {
                 if (SHOW_PLANTS) {
                     // grass
-                    if (simplex2(-x * 0.1, z * 0.1, 4, 0.8, 2) > 0.6) {
+                    if (simplex2_state(
+                        perm, -x * 0.1, z * 0.1, 4, 0.8, 2) > 0.6)
+                    {
                         func(x, h, z, 17 * flag, arg);
                     }
                     // flowers
-                    if (simplex2(x * 0.05, -z * 0.05, 4, 0.8, 2) > 0.7) {
-                        int w = 18 + simplex2(x * 0.1, z * 0.1, 4, 0.8, 2) * 7;
+                    if (simplex2_state(
+                        perm, x * 0.05, -z * 0.05, 4, 0.8, 2) > 0.7)
+                    {
+                        int w = 18 + simplex2_state(
+                            perm, x * 0.1, z * 0.1, 4, 0.8, 2) * 7;
                         func(x, h, z, w * flag, arg);
                     }
                 }
@@ -45,7 +60,7 @@ void create_world(int p, int q, world_func func, void *arg) {
                 {
                     ok = 0;
                 }
-                if (ok && simplex2(x, z, 6, 0.5, 2) > 0.84) {
+                if (ok && simplex2_state(perm, x, z, 6, 0.5, 2) > 0.84) {
                     for (int y = h + 3; y < h + 8; y++) {
                         for (int ox = -3; ox <= 3; ox++) {
                             for (int oz = -3; oz <= 3; oz++) {
@@ -65,7 +80,7 @@ void create_world(int p, int q, world_func func, void *arg) {
             // clouds
             if (SHOW_CLOUDS) {
                 for (int y = 64; y < 72; y++) {
-                    if (simplex3(
+                    if (simplex3_state(perm,
                         x * 0.01, y * 0.1, z * 0.01, 8, 0.5, 2) > 0.75)
                     {
                         func(x, y, z, 16 * flag, arg);
@@ -75,3 +90,34 @@ void create_world(int p, int q, world_func func, void *arg) {
         }
     }
 }
+
+void create_world(int p, int q, world_func func, void *arg) {
+    create_world_state(0, p, q, func, arg);
+}
+
+static void volume_func(int x, int y, int z, int w, void *arg) {
+    WorldVolume *volume = (WorldVolume *)arg;
+    int dx = x - volume->x;
+    int dz = z - volume->z;
+    if (dx < 0 || dz < 0 || dx >= WORLD_WIDTH || dz >= WORLD_WIDTH) {
+        return;
+    }
+    if (y < 0 || y >= WORLD_HEIGHT) {
+        return;
+    }
+    volume->data[(dx * WORLD_HEIGHT + y) * WORLD_WIDTH + dz] = w;
+}
+
+// fills a dense WORLD_WIDTH x WORLD_HEIGHT x WORLD_WIDTH volume (x, y, z
+// order) covering the chunk plus its one block padding; perm is a noise
+// state from seed_state or NULL for the default one
+void create_world_volume(
+    const unsigned char *perm, int p, int q, signed char *data)
+{
+    WorldVolume volume;
+    volume.x = p * CHUNK_SIZE - 1;
+    volume.z = q * CHUNK_SIZE - 1;
+    volume.data = data;
+    memset(data, 0, WORLD_WIDTH * WORLD_HEIGHT * WORLD_WIDTH);
+    create_world_state(perm, p, q, volume_func, &volume);
+}
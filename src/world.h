@@ -1,8 +1,15 @@
 #ifndef _world_h_
 #define _world_h_
 
+#define WORLD_WIDTH (CHUNK_SIZE + 2)
+#define WORLD_HEIGHT 256
+
 typedef void (*world_func)(int, int, int, int, void *);
 
 void create_world(int p, int q, world_func func, void *arg);
+void create_world_state(
+    const unsigned char *perm, int p, int q, world_func func, void *arg);
+void create_world_volume(
+    const unsigned char *perm, int p, int q, signed char *data);
 
 #endif
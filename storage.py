@@ -0,0 +1,64 @@
+import sqlite3
+import time
+
+class Storage(object):
+    # a sqlite connection with explicit durability settings; commit_interval
+    # of None disables time-based commits and commit_operations of 0
+    # disables commits by number of changed rows; transactions are managed
+    # here rather than by the sqlite3 module, which would commit before
+    # every savepoint
+    def __init__(self, path, journal_mode='wal', synchronous='normal',
+            cache_size=64 * 1024 * 1024, mmap_size=0, commit_interval=5,
+            commit_operations=0, readonly=False):
+        self.connection = sqlite3.connect(path, isolation_level=None)
+        self.readonly = readonly
+        self.in_transaction = False
+        self.commit_interval = commit_interval
+        self.commit_operations = commit_operations
+        if readonly:
+            self.pragma('query_only', 1)
+        else:
+            self.pragma('journal_mode', journal_mode)
+            self.pragma('synchronous', synchronous)
+        self.pragma('cache_size', -(cache_size // 1024))
+        self.pragma('mmap_size', mmap_size)
+        self.last_commit = time.time()
+        self.last_changes = self.connection.total_changes
+    def pragma(self, name, value):
+        return list(self.connection.execute('pragma %s = %s;' % (name, value)))
+    def begin(self):
+        if not self.readonly and not self.in_transaction:
+            self.connection.execute('begin;')
+            self.in_transaction = True
+    def execute(self, query, args=()):
+        self.begin()
+        return self.connection.execute(query, args)
+    def executemany(self, query, rows):
+        # applies all of the rows or, if one fails, none of them
+        self.begin()
+        self.connection.execute('savepoint executemany;')
+        try:
+            result = self.connection.executemany(query, rows)
+        except Exception:
+            self.connection.execute('rollback to executemany;')
+            self.connection.execute('release executemany;')
+            raise
+        self.connection.execute('release executemany;')
+        return result
+    def commit_due(self):
+        if self.commit_operations:
+            changes = self.connection.total_changes - self.last_changes
+            if changes >= self.commit_operations:
+                return True
+        if self.commit_interval is not None:
+            if time.time() - self.last_commit > self.commit_interval:
+                return True
+        return False
+    def commit(self):
+        self.last_commit = time.time()
+        self.last_changes = self.connection.total_changes
+        if self.in_transaction:
+            self.in_transaction = False
+            self.connection.execute('commit;')
+    def close(self):
+        self.connection.close()
@@ -1,22 +1,54 @@
 # gcc -std=c99 -O3 -shared -o world \
 #   -I src -I deps/noise deps/noise/noise.c src/world.c
 
-from ctypes import CDLL, CFUNCTYPE, c_float, c_int, c_void_p
-from collections import OrderedDict
+from array import array
+from cache import LRUCache
+from ctypes import CDLL, c_float, c_int, c_uint, c_void_p
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+import mmap
+import os
+import struct
+import threading
+import zlib
 
 dll = CDLL('./world')
 
-WORLD_FUNC = CFUNCTYPE(None, c_int, c_int, c_int, c_int, c_void_p)
+CHUNK_SIZE = 32
+WIDTH = CHUNK_SIZE + 2
+HEIGHT = 256
+SLAB_SIZE = HEIGHT * WIDTH
+VOLUME_SIZE = WIDTH * SLAB_SIZE
+STATE_SIZE = 512
+
+# bump whenever create_world changes its output
+GENERATOR_VERSION = 1
+
+STORE_HEADER = struct.pack('<8sI', 'CRAFTWLD', GENERATOR_VERSION)
+STORE_RECORD = struct.Struct('<iiII')
+
+seed_lock = threading.Lock()
 
 def dll_seed(x):
     dll.seed(x)
 
-def dll_create_world(p, q):
-    result = {}
-    def world_func(x, y, z, w, arg):
-        result[(x, y, z)] = w
-    dll.create_world(p, q, WORLD_FUNC(world_func), None)
-    return result
+dll.seed_state.restype = None
+dll.seed_state.argtypes = [c_void_p, c_uint]
+def dll_seed_state(x):
+    # seed_state shuffles with the C library's global rand()
+    state = array('B', [0]) * STATE_SIZE
+    with seed_lock:
+        dll.seed_state(state.buffer_info()[0], x)
+    return state
+
+dll.create_world_volume.restype = None
+dll.create_world_volume.argtypes = [c_void_p, c_int, c_int, c_void_p]
+def dll_create_world(p, q, state=None):
+    # ctypes releases the GIL for the call, so threads generate in parallel
+    data = array('b', [0]) * VOLUME_SIZE
+    perm = state.buffer_info()[0] if state is not None else None
+    dll.create_world_volume(perm, p, q, data.buffer_info()[0])
+    return data
 
 dll.simplex2.restype = c_float
 dll.simplex2.argtypes = [c_float, c_float, c_int, c_float, c_float]
@@ -28,21 +60,159 @@ dll.simplex3.argtypes = [c_float, c_float, c_float, c_int, c_float, c_float]
 def dll_simplex3(x, y, z, octaves=1, persistence=0.5, lacunarity=2.0):
     return dll.simplex3(x, y, z, octaves, persistence, lacunarity)
 
+class Chunk(object):
+    # the generated blocks of a chunk and its one block padding; the
+    # dense volume is kept as one (y, z) slab per x with the air above
+    # the slab's highest block trimmed off
+    def __init__(self, p, q, data):
+        if not isinstance(data, str):
+            data = data.tostring()
+        self.p = p
+        self.q = q
+        self.x = p * CHUNK_SIZE - 1
+        self.z = q * CHUNK_SIZE - 1
+        self.slabs = []
+        self.nbytes = 0
+        for start in xrange(0, VOLUME_SIZE, SLAB_SIZE):
+            slab = data[start:start + SLAB_SIZE].rstrip('\0')
+            slab = array('b', slab)
+            self.slabs.append(slab)
+            self.nbytes += len(slab) + 64
+    def get(self, x, y, z):
+        dx, dz = x - self.x, z - self.z
+        if 0 <= dx < WIDTH and 0 <= dz < WIDTH and 0 <= y < HEIGHT:
+            slab = self.slabs[dx]
+            index = y * WIDTH + dz
+            if index < len(slab):
+                return slab[index]
+        return 0
+    def __iter__(self):
+        # yields (x, y, z, w) for every non-air block
+        for dx, slab in enumerate(self.slabs):
+            x = self.x + dx
+            for index, w in enumerate(slab):
+                if w:
+                    y, dz = divmod(index, WIDTH)
+                    yield (x, y, self.z + dz, w)
+    def tostring(self):
+        return ''.join(slab.tostring().ljust(SLAB_SIZE, '\0')
+            for slab in self.slabs)
+
+class ChunkStore(object):
+    # append-only file of zlib compressed chunk volumes for one seed and
+    # generator version, read through mmap; every record is a single
+    # O_APPEND write so several processes may fill the same store
+    def __init__(self, path, seed=None):
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        name = 'world-%s-v%d.bin' % (
+            'default' if seed is None else seed, GENERATOR_VERSION)
+        self.path = os.path.join(path, name)
+        flags = os.O_RDWR | os.O_APPEND
+        try:
+            self.fd = os.open(self.path, flags | os.O_CREAT | os.O_EXCL, 0644)
+            os.write(self.fd, STORE_HEADER)
+        except OSError:
+            self.fd = os.open(self.path, flags)
+        self.index = {}
+        self.map = None
+        self.size = 0
+        self.scan()
+        if self.size and self.size < os.fstat(self.fd).st_size:
+            # drop a record torn by a crash mid append, so that new records
+            # are not written after it where scan would never reach them
+            os.ftruncate(self.fd, self.size)
+            self.remap(self.size)
+    def remap(self, size):
+        if self.map is not None:
+            self.map.close()
+        self.map = mmap.mmap(self.fd, size, access=mmap.ACCESS_READ)
+    def scan(self):
+        # indexes records appended since the last scan, stopping at the
+        # first incomplete or corrupt one
+        size = os.fstat(self.fd).st_size
+        if size <= max(self.size, len(STORE_HEADER)):
+            return
+        self.remap(size)
+        if not self.size:
+            if self.map[:len(STORE_HEADER)] != STORE_HEADER:
+                raise ValueError('%s is not a chunk store' % self.path)
+            self.size = len(STORE_HEADER)
+        offset = self.size
+        while offset + STORE_RECORD.size <= size:
+            p, q, length, crc = STORE_RECORD.unpack_from(self.map, offset)
+            start = offset + STORE_RECORD.size
+            if start + length > size:
+                break
+            payload = self.map[start:start + length]
+            if zlib.crc32(payload) & 0xffffffff != crc:
+                break
+            self.index[(p, q)] = (start, length, crc)
+            offset = start + length
+        self.size = offset
+    def __contains__(self, key):
+        if key not in self.index:
+            self.scan()
+        return key in self.index
+    def get(self, p, q):
+        if (p, q) not in self:
+            return None
+        start, length, crc = self.index[(p, q)]
+        if self.map is None or start + length > len(self.map):
+            self.remap(os.fstat(self.fd).st_size)
+        payload = self.map[start:start + length]
+        if zlib.crc32(payload) & 0xffffffff != crc:
+            return None
+        return zlib.decompress(payload)
+    def put(self, p, q, data):
+        payload = zlib.compress(data)
+        crc = zlib.crc32(payload) & 0xffffffff
+        record = STORE_RECORD.pack(p, q, len(payload), crc)
+        os.write(self.fd, record + payload)
+        # index the record right away, replacing any stale entry, since
+        # scan may never reach it
+        end = os.lseek(self.fd, 0, os.SEEK_CUR)
+        self.index[(p, q)] = (end - len(payload), len(payload), crc)
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+        os.close(self.fd)
+
 class World(object):
-    def __init__(self, seed=None, cache_size=64):
+    def __init__(self, seed=None, cache_bytes=256 * 1024 * 1024,
+            workers=None, store=None):
         self.seed = seed
-        self.cache = OrderedDict()
-        self.cache_size = cache_size
+        self.state = None if seed is None else dll_seed_state(seed)
+        self.cache = LRUCache(cache_bytes)
+        self.workers = workers or cpu_count()
+        self.pool = None
+        self.store = None if store is None else ChunkStore(store, seed)
     def create_chunk(self, p, q):
-        if self.seed is not None:
-            dll_seed(self.seed)
-        return dll_create_world(p, q)
+        return Chunk(p, q, dll_create_world(p, q, self.state))
+    def load_chunk(self, p, q):
+        if self.store is not None:
+            data = self.store.get(p, q)
+            if data is not None:
+                return Chunk(p, q, data)
+        chunk = self.create_chunk(p, q)
+        if self.store is not None:
+            self.store.put(p, q, chunk.tostring())
+        return chunk
+    def prewarm(self, chunks):
+        # fills the store with the given (p, q) chunks, returns how many
+        # had to be generated
+        missing = [x for x in chunks if x not in self.store]
+        for chunk in self.generate_many(missing):
+            self.store.put(chunk.p, chunk.q, chunk.tostring())
+        return len(missing)
+    def generate_many(self, chunks):
+        # generates (p, q) chunks on a thread pool, yielding them in order
+        if self.pool is None:
+            self.pool = ThreadPool(self.workers)
+        return self.pool.imap(lambda chunk: self.create_chunk(*chunk), chunks)
     def get_chunk(self, p, q):
-        try:
-            chunk = self.cache.pop((p, q))
-        except KeyError:
-            chunk = self.create_chunk(p, q)
-        self.cache[(p, q)] = chunk
-        if len(self.cache) > self.cache_size:
-            self.cache.popitem(False)
+        chunk = self.cache.get((p, q))
+        if chunk is None:
+            chunk = self.load_chunk(p, q)
+            self.cache.set((p, q), chunk, chunk.nbytes)
         return chunk